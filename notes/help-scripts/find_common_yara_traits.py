@@ -10,8 +10,19 @@ What it looks for:
 - Stable byte runs at fixed offsets near the start of the file
 - Common suffix bytes near the end of the file
 - Candidate YARA hex pattern with wildcards for variable bytes
-- Common ASCII and UTF-16LE strings
+- Common ASCII, UTF-16LE and UTF-16BE strings, plus strings decoded from
+  base64/hex blobs and optionally single-byte XOR (--xor-strings)
 - Optional libmagic MIME/description clustering if python-magic is installed
+- Optional PE/ELF/Mach-O structure: common sections, imports, Rich header
+  entries and stable bytes at the entry point (--structure)
+- Optional windowed entropy profiles and common high-entropy regions (--entropy)
+
+Samples can also be read straight out of zip (including "infected"-password),
+tar and gzip archives without extracting them (--archives), and byte-identical
+copies can be analyzed once and counted once or per copy (--dedup).
+
+Per-offset header/footer analysis is vectorized with NumPy when it is installed
+and falls back to pure Python otherwise.
 
 Example:
     python find_common_yara_traits.py /path/to/samples --recursive --top-strings 30
@@ -21,8 +32,22 @@ Example:
         --top-strings 30 \
         --min-run 4 \
         --string-presence 1.0 \
+        --jobs 8 \
         --json-out report.json
 
+    # Index a clean corpus once, then rank traits by how rare they are in it.
+    python find_common_yara_traits.py /path/to/goodware --recursive \
+        --ngram-size 16 --build-background-index goodware.idx
+    python find_common_yara_traits.py /path/to/samples --recursive \
+        --ngram-size 16 --background-index goodware.idx --max-background-fraction 0.01
+
+    # Keep the report current while a triage pipeline drops samples in.
+    python find_common_yara_traits.py /path/to/incoming --watch --json-out live.json
+
+    # See where the time goes: per-phase timings on stderr, profile of one phase.
+    python find_common_yara_traits.py /path/to/samples --recursive --stats \
+        --jobs 1 --profile-phase extract --profile-out extract.prof
+
 Tip:
     Start by running this against a clean set of known-related files. Then use the
     strongest shared traits in a YARA rule and validate them against unrelated files.
@@ -31,17 +56,151 @@ Tip:
 from __future__ import annotations
 
 import argparse
+import base64
 import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
 import json
+import marshal
 import math
+import mmap
 import os
 import pathlib
+import random
 import re
-import statistics
-from typing import Dict, Iterable, List, Sequence
+import sqlite3
+import stat
+import struct
+import sys
+import tarfile
+import tempfile
+import time
+import types
+import zipfile
+import zlib
+from typing import Dict, Iterable, Iterator, List, Sequence
+
+try:
+    import numpy as np  # type: ignore
+except Exception:
+    np = None
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
 
 ASCII_PRINTABLE_RE_TEMPLATE = rb"[\x20-\x7e]{%d,}"
 UTF16LE_PRINTABLE_RE_TEMPLATE = rb"(?:[\x20-\x7e]\x00){%d,}"
+# Spells out the first pair, so the pattern starts with a literal NUL that the
+# regex engine can skip ahead to; %d is the minimum length minus one.
+UTF16BE_PRINTABLE_RE_TEMPLATE = rb"\x00[\x20-\x7e](?:\x00[\x20-\x7e]){%d,}"
+ASCII_PRINTABLE_BYTES = bytes(range(0x20, 0x7F))
+# Matched against reversed data: an optional unpaired character, then pairs.
+UTF16LE_TRAILING_RE = re.compile(rb"[\x20-\x7e]?(?:\x00[\x20-\x7e])*")
+UTF16BE_TRAILING_RE = re.compile(rb"\x00?(?:[\x20-\x7e]\x00)*")
+BLOB_MIN_CHARS = 24
+BASE64_BLOB_RE = re.compile(rb"[A-Za-z0-9+/]{%d,}={0,2}" % BLOB_MIN_CHARS)
+HEX_BLOB_RE = re.compile(rb"(?:[0-9A-Fa-f]{2})+")
+# English letter frequencies (percent), used to pick the most plausible key
+# when brute-forcing single-byte XOR. Upper case counts half; digits and common
+# path/URL punctuation count 1.0 and other printable characters 0.05.
+LETTER_FREQUENCIES = {
+    " ": 13.0, "e": 12.7, "t": 9.1, "a": 8.2, "o": 7.5, "i": 7.0, "n": 6.7,
+    "s": 6.3, "h": 6.1, "r": 6.0, "d": 4.3, "l": 4.0, "c": 2.8, "u": 2.8,
+    "m": 2.4, "w": 2.4, "f": 2.2, "g": 2.0, "y": 2.0, "p": 1.9, "b": 1.5,
+    "v": 1.0, "k": 0.8, "j": 0.15, "x": 0.15, "q": 0.1, "z": 0.07,
+}
+XOR_MIN_LEN = 12
+# A decoded run must read like words: at least this fraction of it in letter
+# runs of three or more that are cased like a word (lower, UPPER, Capitalized
+# or CamelCase) and, from five letters on, have a plausible share of vowels;
+# one of them must have five letters or more.
+XOR_WORD_RE = re.compile(r"[A-Za-z]{3,}")
+XOR_WORD_CASE_RE = re.compile(r"[A-Z]?[a-z]{2,}(?:[A-Z][a-z]+)*[A-Z]?|[A-Z]+")
+XOR_MIN_WORD_FRACTION = 0.5
+XOR_VOWEL_SHARE = (0.2, 0.6)
+# Decoded machine code repeats itself at short lags; text rarely does.
+XOR_MAX_LAG = 8
+XOR_MAX_LAG_MATCHES = 0.25
+XOR_CANDIDATE_SCORE = 0.8
+XOR_EDGE_SCORE = -2.0
+XOR_MIN_SCORE = 1.3
+XOR_PLAIN_MARGIN = 1.5
+XOR_SCORE_PREFIX = 64
+XOR_BATCH_RUNS = 4096
+STRING_CHUNK_BYTES = 16 * 1024 * 1024
+FEATURE_CACHE_VERSION = 6
+CONSENSUS_BLOCK_BYTES = 16 * 1024 * 1024
+NGRAM_HASH_BASE = 0x100000001B3
+NGRAM_HASH_MIX = 0x9E3779B97F4A7C15
+NGRAM_BLOCK_BYTES = 1024 * 1024
+NGRAM_MAX_REPRESENTATIVES = 16
+NGRAM_HEX_PREVIEW = 64
+HASH_MERGE_BATCH = 4 * 1024 * 1024
+MASK64 = (1 << 64) - 1
+MINHASH_BLOCK_CELLS = 4 * 1024 * 1024
+SIMILARITY_HEADER_BYTES = 64
+STRUCTURE_MAX_ITEMS = 4096
+STRUCTURE_ENTRY_BYTES = 64
+MACHO_MAGICS = {
+    b"\xce\xfa\xed\xfe",
+    b"\xcf\xfa\xed\xfe",
+    b"\xfe\xed\xfa\xce",
+    b"\xfe\xed\xfa\xcf",
+}
+ENTROPY_BLOCK_CELLS = 4 * 1024 * 1024
+ENTROPY_PROFILE_BINS = 64
+ENTROPY_SAMPLE_WINDOWS = 256
+ENTROPY_MAX_REGIONS = 8
+# Entropy histograms for the report's medians, in bins of this many bits.
+ENTROPY_HISTOGRAM_STEP = 0.01
+# Sample sizes are counted exactly up to this many distinct values, then in
+# log-scale bins of SIZE_BINS_PER_OCTAVE per doubling (about 1% wide).
+SIZE_EXACT_VALUES = 4096
+SIZE_BINS_PER_OCTAVE = 64
+ZIP_MAGICS = (b"PK\x03\x04", b"PK\x05\x06")
+GZIP_MAGIC = b"\x1f\x8b"
+# Compressed streams that tarfile can open; anything else needs the ustar magic.
+TAR_COMPRESSION_MAGICS = (GZIP_MAGIC, b"BZh", b"\xfd7zXZ\x00")
+ARCHIVE_BUFFER_BYTES = 64 * 1024 * 1024
+ARCHIVE_ERRORS = (
+    OSError,
+    EOFError,
+    RuntimeError,
+    NotImplementedError,
+    KeyError,
+    zlib.error,
+    zipfile.BadZipFile,
+    tarfile.TarError,
+)
+PREFETCH_READAHEAD_BYTES = 8 * 1024 * 1024
+WATCH_MAX_DEBOUNCES = 10
+STATS_TOP_FILES = 10
+STATS_PHASES = (
+    "walk",
+    "archives",
+    "dedup",
+    "extract",
+    "cluster",
+    "aggregate",
+    "report",
+    "validation",
+    "output",
+)
+SAMPLE_CONFIDENCE = 0.95
+SAMPLE_CONFIDENCE_Z = 1.959964
+DEDUP_PREFIX_BYTES = 64 * 1024
+DEDUP_REPORT_GROUPS = 10
+BACKGROUND_INDEX_MAGIC = b"YTBGIDX1"
+BACKGROUND_INDEX_HEADER = struct.Struct("<8sQQQII")
 
 
 def parse_args() -> argparse.Namespace:
@@ -82,6 +241,14 @@ def parse_args() -> argparse.Namespace:
         default=4,
         help="Minimum length for a stable byte run at a fixed offset",
     )
+    parser.add_argument(
+        "--byte-quorum",
+        type=float,
+        default=1.0,
+        help="Fraction of files that must share a byte for header/footer analysis "
+        "(below 1.0, files too short to reach an offset count as disagreeing "
+        "instead of truncating the analysis)",
+    )
     parser.add_argument(
         "--min-string-len",
         type=int,
@@ -94,331 +261,4067 @@ def parse_args() -> argparse.Namespace:
         default=1.0,
         help="Fraction of files a string must appear in (1.0 = all files)",
     )
+    parser.add_argument(
+        "--string-chunk-bytes",
+        type=int,
+        default=STRING_CHUNK_BYTES,
+        help="Scan each file for strings in windows of this many bytes",
+    )
+    parser.add_argument(
+        "--string-byte-budget",
+        type=int,
+        default=0,
+        help="Only scan the first N bytes of each file for strings (0 = whole file)",
+    )
+    parser.add_argument(
+        "--max-tracked-strings",
+        type=int,
+        default=0,
+        help="Count strings approximately, tracking at most about 2*N of them (0 = exact)",
+    )
     parser.add_argument(
         "--top-strings", type=int, default=25, help="How many common strings to print"
     )
+    parser.add_argument(
+        "--xor-strings",
+        action="store_true",
+        help="Also brute-force single-byte XOR keys for hidden strings (needs NumPy)",
+    )
+    parser.add_argument(
+        "--xor-byte-budget",
+        type=int,
+        default=1024 * 1024,
+        help="Bytes per file searched by --xor-strings (0 = all scanned bytes)",
+    )
+    parser.add_argument(
+        "--max-offset-range",
+        type=int,
+        default=65536,
+        help="Suggest '$s in (a..b)' for a common string only if its first "
+        "occurrence stays within a window this wide",
+    )
+    parser.add_argument(
+        "--structure",
+        action="store_true",
+        help="Parse PE/ELF/Mach-O headers and report common sections, imports, "
+        "Rich header entries and stable bytes at the entry point",
+    )
+    parser.add_argument(
+        "--entropy",
+        action="store_true",
+        help="Profile windowed Shannon entropy per file and across the corpus "
+        "(needs NumPy)",
+    )
+    parser.add_argument(
+        "--entropy-window",
+        type=int,
+        default=1024,
+        help="Window size in bytes for --entropy",
+    )
+    parser.add_argument(
+        "--entropy-step",
+        type=int,
+        default=0,
+        help="Distance between entropy windows (0 = window size, no overlap)",
+    )
+    parser.add_argument(
+        "--high-entropy",
+        type=float,
+        default=7.2,
+        help="Windows at or above this many bits per byte count as high entropy",
+    )
+    parser.add_argument(
+        "--entropy-time-budget",
+        type=float,
+        default=2.0,
+        help="Seconds per file before --entropy falls back to sampling windows",
+    )
+    parser.add_argument(
+        "--ngram-size",
+        type=int,
+        default=0,
+        help="Find byte n-grams of this length shared at any offset, e.g. 16 "
+        "(0 = off, needs NumPy); uses --string-presence as the threshold",
+    )
+    parser.add_argument(
+        "--ngram-window",
+        type=int,
+        default=8,
+        help="Winnowing window: keep the smallest n-gram hash of every W positions",
+    )
+    parser.add_argument(
+        "--ngram-byte-budget",
+        type=int,
+        default=16 * 1024 * 1024,
+        help="Only hash the first N bytes of each file for n-grams (0 = whole file)",
+    )
+    parser.add_argument(
+        "--max-tracked-ngrams",
+        type=int,
+        default=1_000_000,
+        help="Track at most about 2*N n-gram hashes when counting document frequency",
+    )
+    parser.add_argument(
+        "--top-ngrams",
+        type=int,
+        default=20,
+        help="How many shared byte sequences to print",
+    )
+    parser.add_argument(
+        "--background-index",
+        help="Goodware index from --build-background-index; annotates traits with "
+        "how common they are in clean files",
+    )
+    parser.add_argument(
+        "--max-background-fraction",
+        type=float,
+        default=1.0,
+        help="Drop traits found in more than this fraction of background files",
+    )
+    parser.add_argument(
+        "--build-background-index",
+        metavar="OUT",
+        help="Treat the directory as clean files and write a background index "
+        "of their strings (and n-grams with --ngram-size) to OUT instead of a report",
+    )
+    parser.add_argument(
+        "--cluster",
+        action="store_true",
+        help="Split mixed sample sets into clusters (MinHash/LSH over strings and "
+        "n-grams) and report traits per cluster; --cache avoids re-reading files",
+    )
+    parser.add_argument(
+        "--minhash-perms",
+        type=int,
+        default=64,
+        help="MinHash signature length used by --cluster (a multiple of --lsh-bands)",
+    )
+    parser.add_argument(
+        "--lsh-bands",
+        type=int,
+        default=16,
+        help="LSH bands; more bands find less similar neighbours",
+    )
+    parser.add_argument(
+        "--cluster-threshold",
+        type=float,
+        default=0.5,
+        help="Minimum estimated Jaccard similarity to join two files in a cluster",
+    )
+    parser.add_argument(
+        "--min-cluster-size",
+        type=int,
+        default=2,
+        help="Clusters smaller than this are listed as unclustered",
+    )
+    parser.add_argument(
+        "--similarity-index",
+        metavar="DB",
+        help="Add every analyzed file's MinHash signature to this SQLite index "
+        "for later --query-index lookups",
+    )
+    parser.add_argument(
+        "--query-index",
+        metavar="DB",
+        help="Treat the directory argument (a file or directory) as query samples "
+        "and list their nearest neighbours in DB instead of writing a report",
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        default=10,
+        help="How many nearest samples --query-index returns per query",
+    )
+    parser.add_argument(
+        "--validate-against",
+        metavar="DIR",
+        help="Check the candidate traits against unrelated files in DIR and report "
+        "per-trait true/false positive rates (uses yara-python if installed)",
+    )
+    parser.add_argument(
+        "--select-traits",
+        action="store_true",
+        help="Propose a small set of traits covering every sample (greedy set "
+        "cover), using --validate-against files as negatives if given",
+    )
+    parser.add_argument(
+        "--cover-depth",
+        type=int,
+        default=1,
+        help="Each sample must match this many selected traits (the N in 'N of them')",
+    )
+    parser.add_argument(
+        "--max-trait-fp",
+        type=float,
+        default=0.0,
+        help="Skip traits matching more than this fraction of negative files",
+    )
     parser.add_argument(
         "--json-out", help="Optional path to write the full report as JSON"
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--jsonl-out",
+        help=(
+            "Stream one JSON line per analyzed file to this path while scanning, "
+            "then the summary report as the last line (its 'files' list is then "
+            "null, so the report does not grow with the corpus)"
+        ),
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Worker processes for per-file feature extraction (0 = one per CPU)",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=4,
+        help=(
+            "Head/tail reads kept in flight on background threads in each "
+            "process, with kernel readahead hints for the scan that follows "
+            "(0 = read inline); raise it on NFS or other high-latency storage"
+        ),
+    )
+    parser.add_argument(
+        "--cache",
+        help="SQLite file used to cache per-file features between runs",
+    )
+    parser.add_argument(
+        "--archives",
+        action="store_true",
+        help=(
+            "Analyze the members of zip, tar(.gz/.bz2/.xz) and gzip files in place "
+            "instead of the archives themselves (note: this includes zip-based "
+            "formats such as JAR, APK and OOXML)"
+        ),
+    )
+    parser.add_argument(
+        "--dedup",
+        choices=("off", "unique", "weighted"),
+        default="off",
+        help=(
+            "Find byte-identical samples first (only same-size files are hashed) "
+            "and extract each content once; 'unique' counts each content once, "
+            "'weighted' counts it once per copy (default: off)"
+        ),
+    )
+    parser.add_argument(
+        "--sample",
+        type=int,
+        default=0,
+        help=(
+            "Analyze a uniform random sample of this many files, drawn in one "
+            "pass over the directory walk, and report string presence for the "
+            "whole directory with 95%% confidence intervals (0 = all files); "
+            "--max-files lowers the sample size"
+        ),
+    )
+    parser.add_argument(
+        "--sample-seed",
+        type=int,
+        default=0,
+        help="Random seed for --sample, so a sample can be drawn again",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help=(
+            "Keep running: fold each new file in the directory into the running "
+            "aggregates and re-emit the report (stdout, --json-out) once no new "
+            "file has arrived for --watch-debounce seconds; stop with Ctrl-C"
+        ),
+    )
+    parser.add_argument(
+        "--watch-poll",
+        type=float,
+        default=2.0,
+        help=(
+            "Seconds between directory scans in --watch mode; a file is picked "
+            "up once its size and mtime are unchanged over one scan"
+        ),
+    )
+    parser.add_argument(
+        "--watch-debounce",
+        type=float,
+        default=5.0,
+        help=(
+            "Quiet period before the report is re-emitted in --watch mode; while "
+            f"files keep arriving it is still emitted every {WATCH_MAX_DEBOUNCES} "
+            "periods"
+        ),
+    )
+    parser.add_argument(
+        "--archive-password",
+        default="infected",
+        help="Password tried on encrypted zip members (default: infected)",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help=(
+            "Record wall/CPU time, bytes, files/s and MB/s per phase, peak RSS "
+            "and the slowest and largest files; printed to stderr and stored "
+            "under 'stats' in the JSON report"
+        ),
+    )
+    parser.add_argument(
+        "--profile-phase",
+        choices=STATS_PHASES,
+        help=(
+            "Also run cProfile over one phase (implies --stats); profile "
+            "'extract' with --jobs 1, otherwise only the waiting is seen"
+        ),
+    )
+    parser.add_argument(
+        "--profile-out",
+        help="Where to write the --profile-phase profile (default: <phase>.prof)",
+    )
+    args = parser.parse_args()
+    if args.minhash_perms <= 0 or args.lsh_bands <= 0:
+        parser.error("--minhash-perms and --lsh-bands must be positive")
+    if args.minhash_perms % args.lsh_bands:
+        parser.error(
+            f"--minhash-perms ({args.minhash_perms}) must be a multiple of "
+            f"--lsh-bands ({args.lsh_bands}), so every band holds whole hash slots"
+        )
+    return args
+
+
+# (size, mtime_ns) per path gathered by iter_files(), so samples are not
+# stat-ed twice. Only used for planning (cache keys, size buckets); reads size
+# the open file itself. --watch clears it before every rescan.
+_WALK_STATS: dict[str, tuple[int, int]] = {}
+
+
+def iter_files(
+    directory: str, recursive: bool, keep_stats: bool = True
+) -> Iterable[pathlib.Path]:
+    """Yield the regular files in ``directory`` (symlinks to files included,
+    symlinked directories not descended into), keeping their stat results
+    for ``sample_stat`` unless ``keep_stats`` is off."""
+    pending = [directory]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as scan:
+                entries = list(scan)
+        except PermissionError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        pending.append(entry.path)
+                    continue
+                st = entry.stat()
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                if keep_stats:
+                    _WALK_STATS[entry.path] = (st.st_size, st.st_mtime_ns)
+                yield pathlib.Path(entry.path)
+
+
+_EXHAUSTED = object()
+
+
+def reservoir_sample(
+    items: Iterable, k: int, rng: random.Random
+) -> tuple[int, list]:
+    """Draw a uniform sample of ``k`` items from an iterable of unknown length
+    in one pass; returns the number of items seen and the sample.
+
+    Uses Li's Algorithm L, which jumps straight to the next replaced item, so
+    random numbers are drawn only O(k log(n/k)) times.
+    """
+    it = iter(items)
+    reservoir = list(itertools.islice(it, k))
+    seen = len(reservoir)
+    if seen < k or k == 0:
+        return seen, reservoir
+    # 1 - random() lies in (0, 1], so the logarithms stay finite.
+    w = math.exp(math.log(1.0 - rng.random()) / k)
+    while True:
+        skip = int(math.log(1.0 - rng.random()) / math.log1p(-w)) if w < 1.0 else 0
+        skipped = sum(1 for _ in itertools.islice(it, skip))
+        seen += skipped
+        if skipped < skip:
+            return seen, reservoir
+        item = next(it, _EXHAUSTED)
+        if item is _EXHAUSTED:
+            return seen, reservoir
+        seen += 1
+        reservoir[rng.randrange(k)] = item
+        w *= math.exp(math.log(1.0 - rng.random()) / k)
+
+
+def presence_interval(count: int, sample: int, population: int) -> tuple[float, float]:
+    """Wilson score interval for the fraction of ``population`` files that
+    contain a trait seen in ``count`` of ``sample`` uniformly drawn files, with
+    the finite population correction (exact when the sample is everything)."""
+    if sample == 0:
+        return 0.0, 1.0
+    p = count / sample
+    if population <= sample:
+        return p, p
+    fpc = (population - sample) / (population - 1)
+    n = sample / fpc
+    z2 = SAMPLE_CONFIDENCE_Z * SAMPLE_CONFIDENCE_Z
+    denom = 1 + z2 / n
+    center = (p + z2 / (2 * n)) / denom
+    half = SAMPLE_CONFIDENCE_Z * math.sqrt(p * (1 - p) / n + z2 / (4 * n * n)) / denom
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+def add_sample_presence(report: dict, sampling: dict) -> None:
+    """Attach ``sampling`` to a report built from a ``--sample`` draw and give
+    every common string its presence estimate for the whole population.
+
+    A report over part of the sample (a cluster, or unique contents) stands
+    for the same share of the population.
+    """
+    report["sampling"] = sampling
+    sample = report["file_count"]
+    population = round(sampling["population"] * sample / max(sampling["sample"], 1))
+    for item in report["common_strings"]:
+        low, high = presence_interval(item["count"], sample, population)
+        fraction = item["count"] / sample if sample else 0.0
+        item["presence"] = {
+            "fraction": round(fraction, 4),
+            "low": round(low, 4),
+            "high": round(high, 4),
+            "estimated_files": round(fraction * population),
+        }
+
+
+def sample_stat(path: pathlib.Path | ArchiveMember):
+    """Stat a sample, reusing the directory walk's result when there is one."""
+    if isinstance(path, ArchiveMember):
+        return path.stat()
+    walked = _WALK_STATS.get(str(path))
+    if walked is None:
+        return path.stat()
+    return types.SimpleNamespace(st_size=walked[0], st_mtime_ns=walked[1])
+
+
+def advise(f, offset: int, length: int, advice: str) -> None:
+    """Pass a ``posix_fadvise`` hint (e.g. ``"WILLNEED"``) for an open file
+    where the platform has it; archive members and other streams are skipped."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(f.fileno(), offset, length, getattr(os, f"POSIX_FADV_{advice}"))
+    except (OSError, AttributeError, ValueError, io.UnsupportedOperation):
+        pass
+
+
+class ArchiveMember:
+    """A sample stored inside a zip, tar or gzip archive.
+
+    Stands in for ``pathlib.Path`` wherever samples are read: ``open()``
+    streams the member out of the archive and ``stat()`` reports the member
+    size with the archive's mtime, so nothing is extracted to disk. ``str()``
+    gives ``archive!member``, which is also the cache and report key.
+    """
+
+    __slots__ = ("archive", "member", "kind", "size", "mtime_ns", "password")
+
+    def __init__(
+        self,
+        archive: str,
+        member: str,
+        kind: str,
+        size: int,
+        mtime_ns: int,
+        password: bytes | None = None,
+    ):
+        self.archive = archive
+        self.member = member
+        self.kind = kind
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.password = password
+
+    def __str__(self) -> str:
+        return f"{self.archive}!{self.member}"
+
+    def __repr__(self) -> str:
+        return f"ArchiveMember({str(self)!r})"
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, ArchiveMember) and str(self) == str(other)
+
+    def __hash__(self) -> int:
+        return hash(str(self))
+
+    # Ordered by display path, also against plain paths in mixed listings.
+    def __lt__(self, other: object) -> bool:
+        return str(self) < str(other)
+
+    def __gt__(self, other: object) -> bool:
+        return str(self) > str(other)
+
+    @property
+    def name(self) -> str:
+        return pathlib.PurePosixPath(self.member).name
+
+    @property
+    def suffix(self) -> str:
+        return pathlib.PurePosixPath(self.member).suffix
+
+    def stat(self) -> types.SimpleNamespace:
+        return types.SimpleNamespace(st_size=self.size, st_mtime_ns=self.mtime_ns)
+
+    def open(self, mode: str = "rb"):
+        return open_archive_member(self)
+
+
+# This process's open archive: key, handle, tar member index and the bytes of
+# the member read last (every reader of one sample shares a decompression).
+_OPEN_ARCHIVE: dict = {}
+
+
+def _zip_file_class():
+    """pyzipper's AESZipFile when installed (AES-encrypted zips), else ZipFile."""
+    try:
+        import pyzipper  # type: ignore
+
+        return pyzipper.AESZipFile
+    except Exception:
+        return zipfile.ZipFile
+
+
+def _archive_handle(member: ArchiveMember):
+    key = (os.getpid(), member.archive)
+    if _OPEN_ARCHIVE.get("key") != key:
+        # A handle inherited across fork shares its file offset; never reuse it.
+        if _OPEN_ARCHIVE.get("key", (None,))[0] == os.getpid():
+            _OPEN_ARCHIVE["handle"].close()
+        _OPEN_ARCHIVE.clear()
+        if member.kind == "zip":
+            handle = _zip_file_class()(member.archive)
+            index = None
+        else:
+            handle = tarfile.open(member.archive, "r:*")
+            index = {info.name: info for info in handle.getmembers()}
+        _OPEN_ARCHIVE.update(key=key, handle=handle, index=index)
+    return _OPEN_ARCHIVE["handle"], _OPEN_ARCHIVE["index"]
+
+
+def _open_member_stream(member: ArchiveMember):
+    if member.kind == "gzip":
+        return gzip.open(member.archive, "rb")
+    handle, index = _archive_handle(member)
+    if member.kind == "zip":
+        return handle.open(member.member, pwd=member.password)
+    return handle.extractfile(index[member.member])
+
+
+def open_archive_member(member: ArchiveMember):
+    """Open an archive member for reading.
+
+    Members up to ``ARCHIVE_BUFFER_BYTES`` are decompressed once into memory
+    and served from there to every reader of the same sample; larger ones are
+    streamed (seeking forward decompresses through the skipped bytes).
+    Archive and decompression errors are raised as OSError.
+    """
+    try:
+        if member.size > ARCHIVE_BUFFER_BYTES:
+            return _open_member_stream(member)
+        buffered = _OPEN_ARCHIVE.get("buffer")
+        if buffered is None or buffered[0] != str(member):
+            # Never more than the listed size (a gzip's is only its trailer's).
+            with _open_member_stream(member) as f:
+                buffered = (str(member), f.read(member.size))
+            _OPEN_ARCHIVE["buffer"] = buffered
+        return io.BytesIO(buffered[1])
+    except ARCHIVE_ERRORS as exc:
+        raise OSError(f"{member}: {exc}") from exc
+
+
+@contextlib.contextmanager
+def sample_buffer(path: pathlib.Path | ArchiveMember):
+    """Read-only buffer over a sample: an mmap of a plain file, or the first
+    ``ARCHIVE_BUFFER_BYTES`` decompressed bytes of an archive member."""
+    if isinstance(path, ArchiveMember):
+        with path.open("rb") as f:
+            yield f.read(ARCHIVE_BUFFER_BYTES)
+        return
+    with path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        yield mm
+
+
+def _list_zip(path: pathlib.Path, st: os.stat_result, password: bytes):
+    members, skipped = [], []
+    with _zip_file_class()(path) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            pwd = password if info.flag_bits & 0x1 else None
+            try:
+                # Opening checks the password and the compression method.
+                zf.open(info, pwd=pwd).close()
+            except ARCHIVE_ERRORS as exc:
+                skipped.append(f"{path}!{info.filename}: {exc}")
+                continue
+            members.append(
+                ArchiveMember(
+                    str(path), info.filename, "zip", info.file_size, st.st_mtime_ns, pwd
+                )
+            )
+    return members, skipped
+
+
+def list_archive(
+    path: pathlib.Path, password: str
+) -> tuple[list[ArchiveMember] | None, list[str]]:
+    """List the regular-file members of a zip, tar (optionally compressed) or
+    gzip file.
+
+    Returns None instead of a member list when ``path`` is no archive. Members
+    that cannot be read (wrong password, unsupported compression) are left out
+    and described in the second item, as is an unreadable archive.
+    """
+    try:
+        st = sample_stat(path)
+        with path.open("rb") as f:
+            header = f.read(512)
+        if header[:4] in ZIP_MAGICS:
+            return _list_zip(path, st, password.encode())
+        if header[257:262] == b"ustar" or header.startswith(TAR_COMPRESSION_MAGICS):
+            try:
+                with tarfile.open(path, "r|*") as tf:
+                    members = [
+                        ArchiveMember(str(path), info.name, "tar", info.size, st.st_mtime_ns)
+                        for info in tf
+                        if info.isfile()
+                    ]
+                if members or not header.startswith(GZIP_MAGIC):
+                    return members, []
+            except tarfile.ReadError:
+                if not header.startswith(GZIP_MAGIC):
+                    return None, []
+            # A gzip-compressed single file. Its size is taken from the ISIZE
+            # trailer rather than by inflating it twice; that is the size modulo
+            # 4 GiB, and of the last member only in a multi-member file.
+            with path.open("rb") as f:
+                f.seek(-4, os.SEEK_END)
+                size = int.from_bytes(f.read(4), "little")
+            name = path.stem if path.suffix.lower() == ".gz" else path.name
+            return [ArchiveMember(str(path), name, "gzip", size, st.st_mtime_ns)], []
+    except ARCHIVE_ERRORS as exc:
+        return [], [f"{path}: {exc}"]
+    return None, []
+
+
+def _map_chunk(func, chunk: Sequence) -> list:
+    return [func(item) for item in chunk]
+
+
+def pool_map(
+    func,
+    items: Sequence,
+    args: argparse.Namespace,
+    batched: bool = False,
+    initializer=None,
+    initargs: tuple = (),
+) -> Iterator:
+    """Yield ``func(item)`` for every item, in order, over ``--jobs`` processes.
+
+    Items go out in chunks of up to 64, with at most ``jobs * 2`` chunks in
+    flight, so finished results cannot pile up in the parent while the
+    consumer falls behind. With ``batched``, ``func`` takes a whole chunk and
+    returns its results as a list. One job or fewer than two items run inline,
+    where ``initializer`` is not called.
+    """
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    if jobs == 1 or len(items) < 2:
+        yield from func(items) if batched else map(func, items)
+        return
+    if _RUN_STATS is not None:
+        _RUN_STATS.workers = True
+    chunksize = max(1, min(64, len(items) // (jobs * 4)))
+    run = func if batched else functools.partial(_map_chunk, func)
+    starts = iter(range(0, len(items), chunksize))
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=initializer, initargs=initargs
+    ) as pool:
+        pending: collections.deque = collections.deque()
+
+        def submit_next() -> None:
+            start = next(starts, None)
+            if start is not None:
+                pending.append(pool.submit(run, items[start : start + chunksize]))
+
+        for _ in range(jobs * 2):
+            submit_next()
+        while pending:
+            results = pending.popleft().result()
+            submit_next()
+            yield from results
+
+
+def expand_archives(
+    paths: Sequence[pathlib.Path], args: argparse.Namespace
+) -> list[pathlib.Path | ArchiveMember]:
+    """Replace zip, tar and gzip files in ``paths`` by their members, in
+    archive order. Archives are listed in the ``--jobs`` process pool."""
+    lister = functools.partial(list_archive, password=args.archive_password)
+    listings = list(pool_map(lister, paths, args))
+
+    expanded: list[pathlib.Path | ArchiveMember] = []
+    for path, (members, skipped) in zip(paths, listings):
+        for message in skipped:
+            print(f"[!] Skipping unreadable archive entry {message}")
+        expanded.extend([path] if members is None else members)
+    return expanded
+
+
+def content_digest(path: pathlib.Path | ArchiveMember, limit: int = 0) -> str | None:
+    """SHA-256 of the first ``limit`` bytes of a sample (0 = all of it), or
+    None when it cannot be read."""
+    digest = hashlib.sha256()
+    try:
+        with path.open("rb") as f:
+            for chunk in _read_chunks(f, limit):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def _digest_many(
+    paths: Sequence[pathlib.Path | ArchiveMember], limit: int, args: argparse.Namespace
+) -> list[str | None]:
+    digest = functools.partial(content_digest, limit=limit)
+    return list(pool_map(digest, paths, args))
+
+
+def find_duplicates(
+    paths: Sequence[pathlib.Path | ArchiveMember], args: argparse.Namespace
+) -> tuple[list, dict, dict]:
+    """Collapse byte-identical samples.
+
+    Only samples that share their size with another one are read at all.
+    Those are compared by a hash of their first ``DEDUP_PREFIX_BYTES`` and only
+    prefix collisions are hashed in full. Returns the unique samples (the
+    first copy of each content, in input order), all copies of each unique
+    sample and a summary for the report.
+    """
+    sizes = [sample_stat(path).st_size for path in paths]
+    by_size: dict[int, list[int]] = collections.defaultdict(list)
+    for i, size in enumerate(sizes):
+        by_size[size].append(i)
+
+    same_size = [i for ids in by_size.values() if len(ids) > 1 for i in ids]
+    digests: dict[int, str | None] = dict(
+        zip(
+            same_size,
+            _digest_many([paths[i] for i in same_size], DEDUP_PREFIX_BYTES, args),
+        )
+    )
+    by_prefix: dict[tuple, list[int]] = collections.defaultdict(list)
+    for i in same_size:
+        if digests[i] is not None:
+            by_prefix[(sizes[i], digests[i])].append(i)
+    # A prefix hash already covers the whole of a small file.
+    full = [
+        i
+        for (size, _), ids in by_prefix.items()
+        if len(ids) > 1 and size > DEDUP_PREFIX_BYTES
+        for i in ids
+    ]
+    digests.update(zip(full, _digest_many([paths[i] for i in full], 0, args)))
+
+    groups: dict[tuple, list[int]] = {}
+    for i in range(len(paths)):
+        digest = digests.get(i)
+        # Samples that were never read (or could not be) stay on their own.
+        key = (sizes[i], digest) if digest is not None else (sizes[i], i)
+        groups.setdefault(key, []).append(i)
+
+    unique = [paths[ids[0]] for ids in groups.values()]
+    copies = {paths[ids[0]]: [paths[i] for i in ids] for ids in groups.values()}
+    duplicated = sorted(
+        ((key, ids) for key, ids in groups.items() if len(ids) > 1),
+        key=lambda item: (-len(item[1]), item[1][0]),
+    )
+    summary = {
+        "mode": args.dedup,
+        "input_files": len(paths),
+        "unique_files": len(unique),
+        "duplicate_files": len(paths) - len(unique),
+        "prefix_hashed_files": len(same_size),
+        "fully_hashed_files": len(full),
+        "duplicate_groups": len(duplicated),
+        "largest_groups": [
+            {
+                "sha256": digests[ids[0]],
+                "size": size,
+                "copies": len(ids),
+                "files": [str(paths[i]) for i in ids[:5]],
+            }
+            for (size, _), ids in duplicated[:DEDUP_REPORT_GROUPS]
+        ],
+    }
+    return unique, copies, summary
+
+
+def safe_read_head_tail(
+    path: pathlib.Path, head_bytes: int, tail_bytes: int, readahead: int = 0
+) -> tuple[bytes, bytes, int]:
+    """Read the first ``head_bytes`` and last ``tail_bytes`` of a sample.
+
+    With ``readahead``, the kernel is also asked to start reading that many
+    bytes from the start in the background, for a full scan that follows.
+    """
+    with path.open("rb") as f:
+        # The file may have changed since the walk; size what is open now.
+        size = path.size if isinstance(path, ArchiveMember) else os.fstat(f.fileno()).st_size
+        if readahead:
+            advise(f, 0, min(size, readahead), "WILLNEED")
+        head = f.read(head_bytes)
+        if size <= tail_bytes:
+            tail = head if len(head) == size else head + f.read()
+        else:
+            f.seek(max(size - tail_bytes, 0))
+            tail = f.read(tail_bytes)
+    return head, tail, size
+
+
+def _trailing_ascii_start(data: bytes) -> int:
+    return len(data.rstrip(ASCII_PRINTABLE_BYTES))
+
+
+def _trailing_utf16_start(data: bytes) -> int:
+    return len(data) - UTF16LE_TRAILING_RE.match(data[::-1]).end()
+
+
+def _trailing_utf16be_start(data: bytes) -> int:
+    return len(data) - UTF16BE_TRAILING_RE.match(data[::-1]).end()
+
+
+# Per encoding: the regex for a minimum length, where a run still open at the
+# end of a block may start, and the key prefix its strings are counted under
+# ("" = plain).
+STRING_ENCODINGS = {
+    "ascii": (
+        lambda n: ASCII_PRINTABLE_RE_TEMPLATE % n,
+        _trailing_ascii_start,
+        "",
+    ),
+    "utf-16le": (
+        lambda n: UTF16LE_PRINTABLE_RE_TEMPLATE % n,
+        _trailing_utf16_start,
+        "",
+    ),
+    "utf-16be": (
+        lambda n: UTF16BE_PRINTABLE_RE_TEMPLATE % max(n - 1, 0),
+        _trailing_utf16be_start,
+        "utf16be",
+    ),
+}
+
+
+def string_key(encoding: str, text: str) -> str:
+    """Counting key for ``text`` found in ``encoding`` form. Plain ASCII and
+    UTF-16LE share the bare text; other forms get an ``encoding\\0`` prefix,
+    which extracted (printable) text can never contain."""
+    return f"{encoding}\x00{text}" if encoding else text
+
+
+def split_string_key(key: str) -> tuple[str, str]:
+    """Inverse of ``string_key``: return ``(encoding, text)``."""
+    encoding, sep, text = key.partition("\x00")
+    return (encoding, text) if sep else ("", key)
+
+
+@functools.lru_cache(maxsize=None)
+def _string_regexes(min_len: int) -> dict[str, re.Pattern]:
+    return {
+        encoding: re.compile(pattern(min_len))
+        for encoding, (pattern, _, _) in STRING_ENCODINGS.items()
+    }
+
+
+def _record_string(found: dict, key: str, offset: int) -> None:
+    if offset < found.get(key, offset + 1):
+        found[key] = offset
+
+
+def _collect_strings(
+    regexes: dict[str, re.Pattern],
+    encoding: str,
+    data: bytes,
+    start: int,
+    end: int,
+    base: int,
+    found: dict,
+) -> None:
+    width = 1 if encoding == "ascii" else 2
+    prefix = STRING_ENCODINGS[encoding][2]
+    for match in regexes[encoding].finditer(data, start, end):
+        # A NUL after the run, or a printable byte before it, means the same
+        # bytes also read as UTF-16LE; the ambiguity goes to the common case.
+        if encoding == "utf-16be" and (
+            data[match.end() : match.end() + 1] == b"\x00"
+            or (match.start() > 0 and 0x20 <= data[match.start() - 1] <= 0x7E)
+        ):
+            continue
+        try:
+            raw = match.group().decode(encoding, errors="ignore")
+            s = raw.strip()
+            if s:
+                offset = base + match.start() + (len(raw) - len(raw.lstrip())) * width
+                _record_string(found, string_key(prefix, s), offset)
+        except Exception:
+            pass
+        if encoding == "ascii" and match.end() - match.start() >= BLOB_MIN_CHARS:
+            _collect_blobs(regexes, match.group(), base + match.start(), found)
+
+
+def _collect_blobs(
+    regexes: dict[str, re.Pattern], text: bytes, offset: int, found: dict
+) -> None:
+    """Decode hex and base64 blobs inside a long printable run and record the
+    ASCII/UTF-16LE strings they contain under the ``hex``/``base64`` keys."""
+    for match in BASE64_BLOB_RE.finditer(text):
+        blob = match.group()
+        try:
+            if HEX_BLOB_RE.fullmatch(blob):
+                encoding, decoded = "hex", bytes.fromhex(blob.decode("ascii"))
+            else:
+                blob = blob.rstrip(b"=")
+                if len(blob) % 4 == 1:
+                    blob = blob[:-1]
+                encoding = "base64"
+                decoded = base64.b64decode(blob + b"=" * (-len(blob) % 4))
+        except ValueError:
+            continue
+        for inner in ("ascii", "utf-16le"):
+            for sub in regexes[inner].finditer(decoded):
+                s = sub.group().decode(inner, errors="ignore").strip()
+                if s:
+                    _record_string(
+                        found, string_key(encoding, s), offset + match.start()
+                    )
+
+
+@functools.lru_cache(maxsize=None)
+def _xor_score_table() -> "np.ndarray":
+    """Per byte, log2 of its English frequency over the uniform 1/95."""
+    frequencies = dict.fromkeys(range(0x20, 0x7F), 0.05)
+    frequencies.update(dict.fromkeys(b"0123456789.:/\\_-?=&%@,", 1.0))
+    for letter, frequency in LETTER_FREQUENCIES.items():
+        frequencies[ord(letter)] = frequency
+        if letter.isalpha():
+            frequencies[ord(letter.upper())] = frequency / 2
+    table = np.full(256, -1000.0, dtype=np.float32)
+    for byte, frequency in frequencies.items():
+        table[byte] = math.log2(frequency * 95 / 100)
+    return table
+
+
+def _word_like(text: str) -> bool:
+    """Whether an XOR-decoded run reads like words rather than decoded code."""
+    for lag in range(1, XOR_MAX_LAG + 1):
+        same = sum(a == b for a, b in zip(text, text[lag:]))
+        if same > XOR_MAX_LAG_MATCHES * (len(text) - lag):
+            return False
+    low, high = XOR_VOWEL_SHARE
+    letters = longest = 0
+    for word in XOR_WORD_RE.findall(text):
+        if not XOR_WORD_CASE_RE.fullmatch(word):
+            continue
+        vowels = sum(c in "aeiouyAEIOUY" for c in word)
+        if len(word) < 5 or low * len(word) <= vowels <= high * len(word):
+            letters += len(word)
+            longest = max(longest, len(word))
+    return longest >= 5 and letters >= XOR_MIN_WORD_FRACTION * len(text)
+
+
+def xor_strings(data: bytes, base: int, min_len: int, found: dict) -> None:
+    """Find strings hidden in ``data`` with a single-byte XOR key.
+
+    A byte decodes to printable ASCII under key ``k`` exactly when the top
+    three bits of ``byte ^ k`` are 001, 010 or 011 (0x7F aside), so printable
+    runs depend only on the key's top three bits, and within a run the top
+    bit never changes. A cumulative-sum pass first keeps only stretches whose
+    top bit is constant for ``min_len`` bytes; one vectorized pass per 3-bit
+    key class then finds the runs for all 32 keys of the class. Each run's
+    prefix is decoded with those keys and scored by English log-likelihood.
+    The best key's decoding, with rare characters trimmed from its edges, is
+    kept if it scores at least ``XOR_MIN_SCORE``, beats the undecoded bytes by
+    ``XOR_PLAIN_MARGIN``, reads like words (``_word_like``) and no
+    better-scoring run from another class overlaps it. Keys below 0x20 keep text printable, so the plain scan
+    already has it, and key 0x20 only swaps letter case; neither is tried.
+    """
+    min_len = max(min_len, XOR_MIN_LEN)
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if len(raw) < min_len:
+        return
+    high = np.concatenate(([0], np.cumsum(raw >> 7, dtype=np.int64)))
+    ones = high[min_len:] - high[:-min_len]
+    window_starts = np.flatnonzero((ones == 0) | (ones == min_len))
+    if not len(window_starts):
+        return
+    breaks = np.flatnonzero(np.diff(window_starts) > min_len)
+    region_starts = window_starts[np.concatenate(([0], breaks + 1))]
+    region_ends = window_starts[np.concatenate((breaks, [len(window_starts) - 1]))]
+    region_ends = region_ends + min_len
+    lengths = region_ends - region_starts
+    firsts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    positions = np.repeat(region_starts - firsts, lengths) + np.arange(lengths.sum())
+    sub = raw[positions]
+    region_edge = np.zeros(len(sub) + 1, dtype=bool)
+    region_edge[firsts] = True
+    region_edge[-1] = True
+    # Runs that are largely NUL bytes are UTF-16 text, and runs that keep
+    # repeating one of the previous two bytes are padding or tables; neither
+    # is XOR-encoded text.
+    zeros = np.concatenate(([0], np.cumsum(sub == 0)))
+    repeated = np.zeros(len(sub), dtype=bool)
+    repeated[1:] = sub[1:] == sub[:-1]
+    repeated[2:] |= sub[2:] == sub[:-2]
+    repeats = np.concatenate(([0], np.cumsum(repeated)))
+
+    top = sub >> 5
+    scores_table = _xor_score_table()
+    candidates = []
+    for key_class in range(1, 8):
+        lookup = np.array([(t ^ key_class) in (1, 2, 3) for t in range(8)])
+        printable = np.concatenate(([False], lookup[top], [False]))
+        starts = np.flatnonzero(printable[1:-1] & (~printable[:-2] | region_edge[:-1]))
+        ends = np.flatnonzero(printable[1:-1] & (~printable[2:] | region_edge[1:])) + 1
+        lengths = ends - starts
+        keep = (
+            (lengths >= min_len)
+            & (4 * (zeros[ends] - zeros[starts]) < lengths)
+            & (4 * (repeats[ends] - repeats[starts]) < lengths)
+        )
+        starts, ends = starts[keep], ends[keep]
+        keys = np.arange(key_class << 5, (key_class + 1) << 5, dtype=np.uint8)
+        for first in range(0, len(starts), XOR_BATCH_RUNS):
+            run_starts = starts[first : first + XOR_BATCH_RUNS]
+            run_ends = ends[first : first + XOR_BATCH_RUNS]
+            lengths = np.minimum(run_ends - run_starts, XOR_SCORE_PREFIX)
+            offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            index = np.repeat(run_starts - offsets, lengths) + np.arange(lengths.sum())
+            decoded = sub[index][None, :] ^ keys[:, None]
+            scores = np.add.reduceat(scores_table[decoded], offsets, axis=1)
+            if key_class == 1:
+                scores[0] = -np.inf  # key 0x20
+            best = scores.argmax(axis=0)
+            best_scores = scores[best, np.arange(len(run_starts))] / lengths
+            for r in np.flatnonzero(best_scores >= XOR_CANDIDATE_SCORE).tolist():
+                start = int(positions[run_starts[r]])
+                end = int(positions[run_ends[r] - 1]) + 1
+                key = int(keys[best[r]])
+                # Trim stray rare characters the run picked up at either edge.
+                char_scores = scores_table[raw[start:end] ^ key]
+                usable = np.flatnonzero(char_scores > XOR_EDGE_SCORE)
+                if not len(usable):
+                    continue
+                end = start + int(usable[-1]) + 1
+                start += int(usable[0])
+                if end - start < min_len:
+                    continue
+                score = float(scores_table[raw[start:end] ^ key].mean())
+                # Score the undecoded bytes over their printable part only, so
+                # text broken up by NULs still counts as plain text.
+                plain_scores = scores_table[raw[start:end]]
+                plain_scores = plain_scores[plain_scores > -1000.0]
+                plain = float(plain_scores.mean()) if len(plain_scores) else -math.inf
+                if score < XOR_MIN_SCORE or score - plain < XOR_PLAIN_MARGIN:
+                    continue
+                if _word_like((raw[start:end] ^ key).tobytes().decode("ascii")):
+                    candidates.append((-score, start, end, key))
+
+    taken: list[tuple[int, int]] = []
+    for _, start, end, key in sorted(candidates):
+        if any(start < other_end and other_start < end for other_start, other_end in taken):
+            continue
+        taken.append((start, end))
+        text = (raw[start:end] ^ key).tobytes().decode("ascii")
+        s = text.strip()
+        if s:
+            offset = base + start + len(text) - len(text.lstrip())
+            _record_string(found, string_key("xor", s), offset)
+
+
+def extract_strings(
+    path: pathlib.Path,
+    min_len: int,
+    chunk_bytes: int = STRING_CHUNK_BYTES,
+    byte_budget: int = 0,
+    xor_bytes: int | None = None,
+) -> dict[str, int]:
+    """Return the strings of at least ``min_len`` characters, each mapped to the
+    file offset of its first occurrence.
+
+    The file is read once, in ``chunk_bytes`` windows, and every encoding in
+    ``STRING_ENCODINGS`` scans each window; hex and base64 blobs inside long
+    ASCII runs are decoded on the way. A printable run still open at the end
+    of a window is carried into the next one, so strings crossing a window
+    edge are found whole; only a single run longer than a whole window gets
+    split. ``byte_budget`` (0 = unlimited) stops after that many bytes.
+
+    With NumPy and ``xor_bytes`` set (0 = whole scan), the first ``xor_bytes``
+    bytes are also brute-forced for single-byte XOR strings, per window.
+    """
+    regexes = _string_regexes(min_len)
+    found: dict[str, int] = {}
+    remaining = byte_budget if byte_budget > 0 else None
+    xor_left = None if xor_bytes is None or np is None else xor_bytes or -1
+    carry = b""
+    base = 0
+    scan_from = dict.fromkeys(STRING_ENCODINGS, 0)
+
+    with path.open("rb") as f:
+        advise(f, 0, 0, "SEQUENTIAL")
+        while True:
+            want = chunk_bytes if remaining is None else min(chunk_bytes, remaining)
+            block = f.read(want) if want else b""
+            if remaining is not None:
+                remaining -= len(block)
+            data = carry + block
+            final = len(block) < want or not want
+
+            if final:
+                scan_to = dict.fromkeys(STRING_ENCODINGS, len(data))
+                cut = len(data)
+            else:
+                scan_to = {
+                    encoding: trailing_start(data)
+                    for encoding, (_, trailing_start, _) in STRING_ENCODINGS.items()
+                }
+                cut = min(scan_to.values())
+                if len(data) - cut > chunk_bytes:
+                    scan_to = dict.fromkeys(STRING_ENCODINGS, len(data))
+                    cut = len(data)
+
+            for encoding in STRING_ENCODINGS:
+                _collect_strings(
+                    regexes,
+                    encoding,
+                    data,
+                    scan_from[encoding],
+                    scan_to[encoding],
+                    base,
+                    found,
+                )
+            if xor_left and block:
+                xor_block = block if xor_left < 0 else block[:xor_left]
+                xor_strings(xor_block, base + len(carry), min_len, found)
+                if xor_left > 0:
+                    xor_left -= len(xor_block)
+
+            if cut == len(data) and final:
+                break
+            carry = data[cut:]
+            base += cut
+            scan_from = {
+                encoding: end - cut for encoding, end in scan_to.items()
+            }
+
+    return found
+
+
+def ngram_hashes(data: bytes, n: int) -> "np.ndarray":
+    """Return a 64-bit Rabin-Karp hash for every ``n``-byte window of ``data``.
+
+    The polynomial is evaluated for all windows at once (``n`` vector steps),
+    then the bits are mixed so the low bits are usable for winnowing.
+    """
+    count = len(data) - n + 1
+    if count <= 0:
+        return np.empty(0, dtype=np.uint64)
+    buf = np.frombuffer(data, dtype=np.uint8).astype(np.uint64)
+    h = np.zeros(count, dtype=np.uint64)
+    for j in range(n):
+        h = h * NGRAM_HASH_BASE + buf[j : j + count]
+    h ^= h >> np.uint64(29)
+    h *= NGRAM_HASH_MIX
+    h ^= h >> np.uint64(32)
+    return h
+
+
+def winnowed_ngrams(
+    data: bytes, n: int, window: int
+) -> tuple["np.ndarray", "np.ndarray"]:
+    """Select n-gram hashes by winnowing; return ``(hashes, positions)``.
+
+    The smallest hash of every ``window`` consecutive n-grams is kept, so a
+    shared byte region yields the same selections in every file that contains
+    it, and no two selected n-grams are more than ``window`` positions apart.
+    Data is hashed in blocks to keep the temporaries small.
+    """
+    block = NGRAM_BLOCK_BYTES
+    all_hashes = []
+    all_positions = []
+    for start in range(0, max(len(data) - n + 1, 0), block):
+        h = ngram_hashes(data[start : start + block + n + window - 2], n)
+        if len(h) < window:
+            picked = np.array([h.argmin()], dtype=np.int64)
+        else:
+            windows = np.lib.stride_tricks.sliding_window_view(h, window)
+            picked = windows[: min(block, len(windows))].argmin(axis=1)
+            picked += np.arange(len(picked))
+        all_hashes.append(h[picked])
+        all_positions.append(picked + start)
+    if not all_positions:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+
+    # The leftmost minimum of a sliding window never moves backwards, so the
+    # picks are already sorted and repeats are adjacent.
+    hashes = np.concatenate(all_hashes)
+    positions = np.concatenate(all_positions)
+    keep = np.ones(len(positions), dtype=bool)
+    keep[1:] = positions[1:] != positions[:-1]
+    return hashes[keep], positions[keep]
+
+
+def distinct_hashes(hashes: "np.ndarray") -> "np.ndarray":
+    hashes = np.sort(hashes)
+    keep = np.ones(len(hashes), dtype=bool)
+    keep[1:] = hashes[1:] != hashes[:-1]
+    return hashes[keep]
+
+
+def read_ngram_sample(path: pathlib.Path, byte_budget: int) -> bytes:
+    with path.open("rb") as f:
+        return f.read(byte_budget) if byte_budget > 0 else f.read()
+
+
+def window_entropies(data: "np.ndarray", starts: "np.ndarray", window: int) -> "np.ndarray":
+    """Shannon entropy (bits per byte) of ``data[s : s + window]`` for each start.
+
+    Windows are taken as a strided view and their byte histograms built with
+    a single ``bincount`` per block of at most ``ENTROPY_BLOCK_CELLS`` bytes.
+    """
+    table = np.zeros(window + 1)
+    nonzero = np.arange(1, window + 1) / window
+    table[1:] = -nonzero * np.log2(nonzero)
+    out = np.empty(len(starts))
+    per_block = max(1, ENTROPY_BLOCK_CELLS // window)
+    windows = np.lib.stride_tricks.sliding_window_view(data, window)
+    for first in range(0, len(starts), per_block):
+        rows = windows[starts[first : first + per_block]].astype(np.int32)
+        rows += (np.arange(len(rows), dtype=np.int32) * 256)[:, None]
+        counts = np.bincount(rows.ravel(), minlength=len(rows) * 256)
+        out[first : first + len(rows)] = table[counts.reshape(len(rows), 256)].sum(axis=1)
+    return out
+
+
+def entropy_profile(path: pathlib.Path, args: argparse.Namespace) -> dict | None:
+    """Windowed entropy of one file, read through mmap.
+
+    Returns the mean and maximum window entropy, a profile of
+    ``ENTROPY_PROFILE_BINS`` values at evenly spaced normalized offsets and the
+    largest high-entropy regions. Once ``--entropy-time-budget`` seconds are
+    spent, the rest of the file is only sampled (``partial`` is then set, as
+    it is for archive members cut short by ``sample_buffer``).
+    """
+    full_size = sample_stat(path).st_size
+    if full_size == 0:
+        return None
+    deadline = time.perf_counter() + args.entropy_time_budget
+    with sample_buffer(path) as buf:
+        size = len(buf)
+        if size == 0:
+            return None
+        window = min(args.entropy_window, size)
+        step = args.entropy_step if args.entropy_step > 0 else window
+        data = np.frombuffer(buf, dtype=np.uint8)
+        try:
+            all_starts = np.arange(0, size - window + 1, step, dtype=np.int64)
+            chunk = max(1, ENTROPY_BLOCK_CELLS // window)
+            parts = []
+            done = 0
+            partial = False
+            while done < len(all_starts):
+                starts = all_starts[done : done + chunk]
+                parts.append((starts, window_entropies(data, starts, window)))
+                done += len(starts)
+                if done < len(all_starts) and time.perf_counter() > deadline:
+                    rest = all_starts[done:]
+                    picks = np.linspace(0, len(rest) - 1, ENTROPY_SAMPLE_WINDOWS)
+                    starts = rest[np.unique(picks.astype(np.int64))]
+                    parts.append((starts, window_entropies(data, starts, window)))
+                    partial = True
+                    break
+            starts = np.concatenate([p[0] for p in parts])
+            values = np.concatenate([p[1] for p in parts])
+        finally:
+            del data
+
+    centers = starts + window // 2
+    bins = np.minimum(centers * ENTROPY_PROFILE_BINS // size, ENTROPY_PROFILE_BINS - 1)
+    sums = np.bincount(bins, weights=values, minlength=ENTROPY_PROFILE_BINS)
+    hits = np.bincount(bins, minlength=ENTROPY_PROFILE_BINS)
+    # Bins no window centre falls into (small files) take the nearest window.
+    bin_centers = (np.arange(ENTROPY_PROFILE_BINS) + 0.5) * size / ENTROPY_PROFILE_BINS
+    nearest = np.clip(np.searchsorted(centers, bin_centers), 0, len(values) - 1)
+    profile = np.where(hits > 0, sums / np.maximum(hits, 1), values[nearest])
+
+    high = np.concatenate(([0], (values >= args.high_entropy).astype(np.int8), [0]))
+    edges = np.flatnonzero(np.diff(high))
+    regions = []
+    for first, last in zip(edges[::2], edges[1::2]):
+        start = int(starts[first])
+        end = int(starts[last - 1]) + window
+        if regions and start <= regions[-1][0] + regions[-1][1]:
+            regions[-1][1] = end - regions[-1][0]
+        else:
+            regions.append([start, end - start])
+    regions = sorted(
+        sorted(regions, key=lambda r: -r[1])[:ENTROPY_MAX_REGIONS]
+    )
+
+    return {
+        "mean": round(float(values.mean()), 4),
+        "max": round(float(values.max()), 4),
+        "profile": [round(float(v), 3) for v in profile],
+        "high_regions": regions,
+        "partial": partial or size < full_size,
+    }
+
+
+def _c_string(buf, offset: int, limit: int = 256) -> str:
+    """Read a NUL-terminated ASCII string at ``offset`` without copying beyond it."""
+    if offset <= 0 or offset >= len(buf):
+        return ""
+    end = buf.find(b"\x00", offset, offset + limit)
+    if end < 0:
+        return ""
+    return buf[offset:end].decode("ascii", errors="ignore")
+
+
+def _pe_rich_entries(buf, pe_offset: int) -> list[str]:
+    """Decode the Rich header between the DOS stub and the PE header.
+
+    Each entry is returned as ``"prod_id.build"`` (the tool that produced part
+    of the image); the per-entry use counts vary too much to be traits.
+    """
+    rich = buf.rfind(b"Rich", 0x40, pe_offset)
+    if rich < 0 or rich + 8 > len(buf):
+        return []
+    (key,) = struct.unpack_from("<I", buf, rich + 4)
+    dans = 0x536E6144 ^ key
+    start = rich - 4
+    while start >= 0x40:
+        if struct.unpack_from("<I", buf, start)[0] == dans:
+            break
+        start -= 4
+    else:
+        return []
+    entries = []
+    for offset in range(start + 16, rich, 8):
+        comp_id = struct.unpack_from("<I", buf, offset)[0] ^ key
+        entries.append(f"{comp_id >> 16}.{comp_id & 0xFFFF}")
+    return entries
+
+
+def _parse_pe(buf) -> dict | None:
+    (pe_offset,) = struct.unpack_from("<I", buf, 0x3C)
+    if buf[pe_offset : pe_offset + 4] != b"PE\x00\x00":
+        return None
+    machine, section_count, _, _, _, optional_size, _ = struct.unpack_from(
+        "<HHIIIHH", buf, pe_offset + 4
+    )
+    optional = pe_offset + 24
+    (opt_magic,) = struct.unpack_from("<H", buf, optional)
+    is64 = opt_magic == 0x20B
+    (entry_rva,) = struct.unpack_from("<I", buf, optional + 16)
+    directories = optional + (112 if is64 else 96)
+    (directory_count,) = struct.unpack_from("<I", buf, directories - 4)
+
+    sections = []
+    names = []
+    table = optional + optional_size
+    for i in range(min(section_count, STRUCTURE_MAX_ITEMS)):
+        name, vsize, vaddr, raw_size, raw_ptr = struct.unpack_from(
+            "<8sIIII", buf, table + 40 * i
+        )
+        names.append(name.rstrip(b"\x00").decode("ascii", errors="replace"))
+        sections.append((vaddr, max(vsize, raw_size), raw_ptr))
+
+    def rva_to_offset(rva: int) -> int:
+        for vaddr, span, raw_ptr in sections:
+            if vaddr <= rva < vaddr + span:
+                return rva - vaddr + raw_ptr
+        if not sections or rva < min(vaddr for vaddr, _, _ in sections):
+            return rva
+        return -1
+
+    libraries = []
+    imports = []
+    if directory_count > 1:
+        import_rva, _ = struct.unpack_from("<II", buf, directories + 8)
+        descriptor = rva_to_offset(import_rva) if import_rva else -1
+        thunk_format, thunk_size = ("<Q", 8) if is64 else ("<I", 4)
+        ordinal_flag = 1 << (63 if is64 else 31)
+        while 0 < descriptor and descriptor + 20 <= len(buf):
+            lookup, _, _, name_rva, first_thunk = struct.unpack_from(
+                "<IIIII", buf, descriptor
+            )
+            if not (lookup or name_rva or first_thunk):
+                break
+            dll = _c_string(buf, rva_to_offset(name_rva)).lower()
+            libraries.append(dll)
+            thunk = rva_to_offset(lookup or first_thunk)
+            for _ in range(STRUCTURE_MAX_ITEMS):
+                if thunk <= 0 or thunk + thunk_size > len(buf):
+                    break
+                (value,) = struct.unpack_from(thunk_format, buf, thunk)
+                if not value or len(imports) >= STRUCTURE_MAX_ITEMS:
+                    break
+                if value & ordinal_flag:
+                    func = f"ord{value & 0xFFFF}"
+                else:
+                    func = _c_string(buf, rva_to_offset(value & 0x7FFFFFFF) + 2)
+                if func:
+                    imports.append(f"{dll}!{func}")
+                thunk += thunk_size
+            if len(libraries) >= STRUCTURE_MAX_ITEMS:
+                break
+            descriptor += 20
+
+    return {
+        "format": "pe32+" if is64 else "pe32",
+        "machine": machine,
+        "sections": names,
+        "libraries": libraries,
+        "imports": imports,
+        "rich": _pe_rich_entries(buf, pe_offset),
+        "entry": rva_to_offset(entry_rva) if entry_rva else -1,
+    }
+
+
+def _parse_elf(buf) -> dict | None:
+    is64 = buf[4] == 2
+    endian = "<" if buf[5] == 1 else ">"
+    if is64:
+        fields = struct.unpack_from(endian + "HHIQQQIHHHHHH", buf, 16)
+    else:
+        fields = struct.unpack_from(endian + "HHIIIIIHHHHHH", buf, 16)
+    _, machine, _, entry, ph_offset, sh_offset, _, _, ph_size, ph_count = fields[:10]
+    sh_size, sh_count, sh_names = fields[10:]
+
+    entry_offset = -1
+    ph_format = endian + ("IIQQQQQQ" if is64 else "IIIIIIII")
+    for i in range(min(ph_count, STRUCTURE_MAX_ITEMS)):
+        ph = struct.unpack_from(ph_format, buf, ph_offset + i * ph_size)
+        if is64:
+            p_type, _, p_offset, p_vaddr, _, p_filesz = ph[:6]
+        else:
+            p_type, p_offset, p_vaddr, _, p_filesz = ph[:5]
+        if p_type == 1 and p_vaddr <= entry < p_vaddr + p_filesz:
+            entry_offset = entry - p_vaddr + p_offset
+            break
+
+    # (name, type, offset, size, link, entsize) per section header
+    sh_format = endian + ("IIQQQQIIQQ" if is64 else "IIIIIIIIII")
+    headers = []
+    for i in range(min(sh_count, STRUCTURE_MAX_ITEMS)):
+        sh = struct.unpack_from(sh_format, buf, sh_offset + i * sh_size)
+        headers.append((sh[0], sh[1], sh[4], sh[5], sh[6], sh[9]))
+
+    def section_string(index: int, offset: int) -> str:
+        if index >= len(headers):
+            return ""
+        return _c_string(buf, headers[index][2] + offset) if offset else ""
+
+    names = [section_string(sh_names, header[0]) for header in headers]
+    libraries = []
+    imports = []
+    for _, sh_type, offset, size, link, entsize in headers:
+        size = min(size, entsize * STRUCTURE_MAX_ITEMS)
+        if sh_type == 6 and entsize:  # SHT_DYNAMIC: DT_NEEDED entries
+            dyn_format = endian + ("qQ" if is64 else "iI")
+            for pos in range(offset, offset + size, entsize):
+                tag, value = struct.unpack_from(dyn_format, buf, pos)
+                if tag == 0:
+                    break
+                if tag == 1:
+                    libraries.append(section_string(link, value))
+        elif sh_type == 11 and entsize:  # SHT_DYNSYM: undefined symbols
+            for pos in range(offset + entsize, offset + size, entsize):
+                if is64:
+                    name, _, _, shndx = struct.unpack_from(endian + "IBBH", buf, pos)
+                else:
+                    name, shndx = struct.unpack_from(endian + "I10xH", buf, pos)
+                if shndx == 0 and name:
+                    imports.append(section_string(link, name))
+                if len(imports) >= STRUCTURE_MAX_ITEMS:
+                    break
+
+    return {
+        "format": "elf64" if is64 else "elf32",
+        "machine": machine,
+        "sections": [name for name in names if name],
+        "libraries": [name for name in libraries if name],
+        "imports": [name for name in imports if name],
+        "rich": [],
+        "entry": entry_offset,
+    }
+
+
+def _parse_macho(buf) -> dict | None:
+    (magic,) = struct.unpack_from("<I", buf, 0)
+    endian = "<" if magic in (0xFEEDFACE, 0xFEEDFACF) else ">"
+    is64 = magic in (0xFEEDFACF, 0xCFFAEDFE)
+    cpu_type, _, _, command_count, _, _ = struct.unpack_from(endian + "iIIIII", buf, 4)
+
+    sections = []
+    libraries = []
+    imports = []
+    entry = -1
+    text_offset = 0
+    position = 32 if is64 else 28
+    for _ in range(min(command_count, STRUCTURE_MAX_ITEMS)):
+        command, size = struct.unpack_from(endian + "II", buf, position)
+        if size < 8:
+            break
+        if command in (0x1, 0x19):  # LC_SEGMENT, LC_SEGMENT_64
+            if is64:
+                segment, _, _, file_offset, _, _, _, count, _ = struct.unpack_from(
+                    endian + "16sQQQQiiII", buf, position + 8
+                )
+                first, stride = position + 72, 80
+            else:
+                segment, _, _, file_offset, _, _, _, count, _ = struct.unpack_from(
+                    endian + "16sIIIIiiII", buf, position + 8
+                )
+                first, stride = position + 56, 68
+            if segment.rstrip(b"\x00") == b"__TEXT":
+                text_offset = file_offset
+            for i in range(min(count, STRUCTURE_MAX_ITEMS)):
+                sect, seg = struct.unpack_from("16s16s", buf, first + i * stride)
+                sections.append(
+                    (seg.rstrip(b"\x00") + b"," + sect.rstrip(b"\x00")).decode(
+                        "ascii", errors="replace"
+                    )
+                )
+        elif command in (0xC, 0x80000018, 0x8000001F):  # LC_(WEAK_|REEXPORT_)DYLIB
+            (name_offset,) = struct.unpack_from(endian + "I", buf, position + 8)
+            libraries.append(_c_string(buf, position + name_offset, size))
+        elif command == 0x80000028:  # LC_MAIN
+            (entry,) = struct.unpack_from(endian + "Q", buf, position + 8)
+        elif command == 0x2:  # LC_SYMTAB: external undefined symbols
+            sym_offset, sym_count, str_offset, _ = struct.unpack_from(
+                endian + "IIII", buf, position + 8
+            )
+            stride = 16 if is64 else 12
+            for i in range(min(sym_count, STRUCTURE_MAX_ITEMS)):
+                name, n_type = struct.unpack_from(
+                    endian + "IB", buf, sym_offset + i * stride
+                )
+                if n_type & 0xEF == 0x01 and name:  # N_EXT, N_UNDF, not a stab
+                    imports.append(_c_string(buf, str_offset + name))
+        position += size
+
+    return {
+        "format": "macho64" if is64 else "macho32",
+        "machine": cpu_type,
+        "sections": sections,
+        "libraries": [name for name in libraries if name],
+        "imports": [name for name in imports if name],
+        "rich": [],
+        "entry": entry + text_offset if entry >= 0 else -1,
+    }
+
+
+def parse_executable(path: pathlib.Path) -> dict | None:
+    """Parse PE, ELF or Mach-O headers through a read-only mmap.
+
+    Returns the format, machine, section names, imported libraries and
+    symbols, Rich header tool ids (PE) and the first ``STRUCTURE_ENTRY_BYTES``
+    bytes at the entry point, or None for other or badly malformed files.
+    Only the header structures and the entry point bytes are touched.
+    """
+    try:
+        with sample_buffer(path) as buf:
+            if buf[:2] == b"MZ":
+                parsed = _parse_pe(buf)
+            elif buf[:4] == b"\x7fELF":
+                parsed = _parse_elf(buf)
+            elif buf[:4] in MACHO_MAGICS:
+                parsed = _parse_macho(buf)
+            else:
+                return None
+            if parsed is None:
+                return None
+            entry = parsed.pop("entry")
+            parsed["entry_bytes"] = (
+                buf[entry : entry + STRUCTURE_ENTRY_BYTES]
+                if 0 <= entry < len(buf)
+                else b""
+            )
+            return parsed
+    except (OSError, ValueError, IndexError, OverflowError, struct.error):
+        return None
+
+
+def file_extension(path: pathlib.Path | ArchiveMember) -> str:
+    return path.suffix.lower() or "<no extension>"
+
+
+@contextlib.contextmanager
+def _untimed(name: str, nbytes: int = 0, files: int = 0) -> Iterator[None]:
+    yield
+
+
+class PhaseTimes:
+    """Wall time, CPU time and bytes per named phase.
+
+    ``phases`` maps a phase name to ``[wall_s, cpu_s, bytes]`` and is small
+    enough to travel back from a worker with the features of one file. CPU
+    time is per thread, so reads prefetched on other threads are not counted.
+    """
+
+    cpu_clock = staticmethod(time.thread_time)
+
+    def __init__(self) -> None:
+        self.phases: dict[str, list] = {}
+
+    def add(self, name: str, wall: float = 0.0, cpu: float = 0.0, nbytes: int = 0) -> None:
+        totals = self.phases.setdefault(name, [0.0, 0.0, 0])
+        totals[0] += wall
+        totals[1] += cpu
+        totals[2] += nbytes
+
+    @contextlib.contextmanager
+    def phase(self, name: str, nbytes: int = 0) -> Iterator[None]:
+        wall, cpu = time.perf_counter(), self.cpu_clock()
+        try:
+            yield
+        finally:
+            self.add(
+                name, time.perf_counter() - wall, self.cpu_clock() - cpu, nbytes
+            )
+
+
+class RunStats(PhaseTimes):
+    """``--stats``: phase timings of the whole run plus per-file counters.
+
+    Top-level phases (walk, extract, aggregate, ...) are timed in the parent
+    with process CPU time, so with ``--jobs`` other than 1 the extract phase
+    is mostly waiting; the per-file steps measured in the workers are summed
+    separately under ``extract_steps``. With ``profile_phase`` a cProfile
+    profile of every run of that phase is written to ``profile_out``.
+    """
+
+    cpu_clock = staticmethod(time.process_time)
+
+    def __init__(self, profile_phase: str | None = None, profile_out: str | None = None):
+        super().__init__()
+        self.files: dict[str, int] = {}
+        self.steps = PhaseTimes()
+        self.extracted = 0
+        self.cached = 0
+        self.slowest: list[tuple[float, str]] = []
+        self.largest: list[tuple[int, str]] = []
+        self.profile_phase = profile_phase
+        self.profile_out = profile_out or f"{profile_phase}.prof"
+        self.profiler = cProfile.Profile() if profile_phase else None
+        self.active: list[str] = []
+        self.seen: set[str] = set()
+        self.workers = False
+        self.started = time.perf_counter(), self.cpu_clock()
+
+    @contextlib.contextmanager
+    def phase(self, name: str, nbytes: int = 0, files: int = 0) -> Iterator[None]:
+        profiling = self.profiler is not None and name == self.profile_phase
+        if profiling:
+            self.profiler.enable()
+        self.active.append(name)
+        try:
+            with super().phase(name, nbytes):
+                yield
+        finally:
+            self.active.pop()
+            if profiling:
+                self.profiler.disable()
+            self.files[name] = self.files.get(name, 0) + files
+
+    def add_file(self, path: pathlib.Path | ArchiveMember, features: dict) -> None:
+        """Record one file coming out of ``iter_features``; the bytes its
+        extraction read count towards the innermost running phase. A file
+        seen again (cluster reports reload the clustering pass's features)
+        is only counted once."""
+        steps = features.pop("stats", None)
+        key = str(path)
+        if key in self.seen:
+            return
+        self.seen.add(key)
+        if steps is None:
+            self.cached += 1
+        else:
+            self.extracted += 1
+            for step, (wall, cpu, nbytes) in steps.items():
+                self.steps.add(step, wall, cpu, nbytes)
+            if self.active:
+                self.add(self.active[-1], nbytes=sum(t[2] for t in steps.values()))
+            self._keep(self.slowest, (sum(t[0] for t in steps.values()), str(path)))
+        self._keep(self.largest, (features["size"], str(path)))
+
+    @staticmethod
+    def _keep(top: list, item: tuple) -> None:
+        if len(top) < STATS_TOP_FILES:
+            heapq.heappush(top, item)
+        elif item > top[0]:
+            heapq.heapreplace(top, item)
+
+    @staticmethod
+    def _rates(wall: float, cpu: float, nbytes: int, files: int) -> dict:
+        row = {"wall_s": round(wall, 4), "cpu_s": round(cpu, 4), "bytes": nbytes}
+        if files:
+            row["files"] = files
+        if wall > 0:
+            if files:
+                row["files_per_s"] = round(files / wall, 1)
+            if nbytes:
+                row["mb_per_s"] = round(nbytes / wall / 1e6, 2)
+        return row
+
+    def peak_rss(self) -> dict | None:
+        if resource is None:
+            return None
+        scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is KiB on Linux
+        peak = {"self_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale}
+        # Only meaningful when this run started a worker pool.
+        if self.workers:
+            peak["largest_worker_bytes"] = (
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+            )
+        return peak
+
+    def result(self) -> dict:
+        if self.profiler is not None:
+            self.profiler.dump_stats(self.profile_out)
+        return {
+            "wall_s": round(time.perf_counter() - self.started[0], 4),
+            "cpu_s": round(self.cpu_clock() - self.started[1], 4),
+            "phases": {
+                name: self._rates(wall, cpu, nbytes, self.files.get(name, 0))
+                for name, (wall, cpu, nbytes) in self.phases.items()
+            },
+            "files_extracted": self.extracted,
+            "files_cached": self.cached,
+            "extract_steps": {
+                name: self._rates(wall, cpu, nbytes, 0)
+                for name, (wall, cpu, nbytes) in self.steps.phases.items()
+            },
+            "peak_rss": self.peak_rss(),
+            "slowest_files": [
+                {"path": path, "wall_s": round(wall, 4)}
+                for wall, path in sorted(self.slowest, reverse=True)
+            ],
+            "largest_files": [
+                {"path": path, "size": size}
+                for size, path in sorted(self.largest, reverse=True)
+            ],
+            "profile": self.profile_out if self.profiler is not None else None,
+        }
+
+
+def print_stats(stats: dict) -> None:
+    """Write a ``RunStats.result()`` summary to stderr."""
+
+    def line(name: str, row: dict) -> str:
+        text = f"  {name:<12} {row['wall_s']:>9.3f}s wall {row['cpu_s']:>9.3f}s cpu"
+        if row["bytes"]:
+            text += f" {row['bytes'] / 1e6:>10.1f} MB"
+        if "files" in row:
+            text += f" {row['files']:>8} files"
+        if "files_per_s" in row:
+            text += f" {row['files_per_s']:>9.1f} files/s"
+        if "mb_per_s" in row:
+            text += f" {row['mb_per_s']:>8.2f} MB/s"
+        return text
+
+    out = sys.stderr
+    print(
+        f"[+] Stats: {stats['wall_s']:.3f}s wall, {stats['cpu_s']:.3f}s cpu "
+        f"(parent), {stats['files_extracted']} files extracted, "
+        f"{stats['files_cached']} from cache",
+        file=out,
+    )
+    for name, row in stats["phases"].items():
+        print(line(name, row), file=out)
+    if stats["extract_steps"]:
+        print("[+] Extraction steps (summed over files):", file=out)
+        for name, row in stats["extract_steps"].items():
+            print(line(name, row), file=out)
+    if stats["peak_rss"] is not None:
+        peak = stats["peak_rss"]
+        line = f"[+] Peak RSS: {peak['self_bytes'] / 2**20:.1f} MiB"
+        if "largest_worker_bytes" in peak:
+            line += f", largest worker {peak['largest_worker_bytes'] / 2**20:.1f} MiB"
+        print(line, file=out)
+    if stats["slowest_files"]:
+        print("[+] Slowest files:", file=out)
+        for item in stats["slowest_files"]:
+            print(f"  {item['wall_s']:>9.3f}s  {item['path']}", file=out)
+    if stats["largest_files"]:
+        print("[+] Largest files:", file=out)
+        for item in stats["largest_files"]:
+            print(f"  {item['size']:>12}  {item['path']}", file=out)
+    if stats["profile"]:
+        print(f"[+] Wrote profile to: {stats['profile']}", file=out)
+
+
+# Set by main() with --stats.
+_RUN_STATS: RunStats | None = None
+
+
+def stats_phase(name: str, nbytes: int = 0, files: int = 0):
+    """Time a top-level phase into ``_RUN_STATS`` (a no-op without --stats)."""
+    if _RUN_STATS is None:
+        return _untimed(name)
+    return _RUN_STATS.phase(name, nbytes, files)
+
+
+def prefetch_head_tail(
+    paths: Sequence[pathlib.Path | ArchiveMember], args: argparse.Namespace
+) -> Iterator[tuple[bytes, bytes, int] | None]:
+    """Yield ``safe_read_head_tail`` results for ``paths`` in order, keeping
+    up to ``--prefetch`` reads in flight on a thread pool.
+
+    Each read also asks the kernel to start reading ahead what the strings
+    scan will need, so on high-latency storage the waits overlap. Archive
+    members share one decompressor per process and yield None (read inline).
+    """
+    readahead = PREFETCH_READAHEAD_BYTES
+    if args.string_byte_budget > 0:
+        readahead = min(readahead, args.string_byte_budget)
+
+    def read(path: pathlib.Path) -> tuple[bytes, bytes, int]:
+        return safe_read_head_tail(path, args.head_bytes, args.tail_bytes, readahead)
+
+    if args.prefetch <= 0:
+        yield from (None for _ in paths)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.prefetch) as pool:
+        pending: collections.deque = collections.deque()
+        upcoming = iter(paths)
+
+        def submit_next() -> None:
+            path = next(upcoming, None)
+            if path is not None:
+                pending.append(
+                    None if isinstance(path, ArchiveMember) else pool.submit(read, path)
+                )
+
+        for _ in range(args.prefetch):
+            submit_next()
+        while pending:
+            future = pending.popleft()
+            submit_next()
+            yield None if future is None else future.result()
+
+
+def extract_features(
+    path: pathlib.Path,
+    args: argparse.Namespace,
+    prefetched: tuple[bytes, bytes, int] | None = None,
+    clock: PhaseTimes | None = None,
+) -> dict:
+    """Extract the per-file features of one sample.
+
+    With ``--stats`` the time and bytes of each step are returned under
+    ``"stats"`` (``clock`` may already hold the wait for a prefetched read).
+    """
+    if clock is None and args.stats:
+        clock = PhaseTimes()
+    timed = clock.phase if clock is not None else _untimed
+    with timed("read"):
+        if prefetched is None:
+            prefetched = safe_read_head_tail(path, args.head_bytes, args.tail_bytes)
+    head, tail, size = prefetched
+    with timed("magic"):
+        magic = try_magic(head)
+    scanned = size if args.string_byte_budget <= 0 else min(size, args.string_byte_budget)
+    with timed("strings", scanned):
+        strings = extract_strings(
+            path,
+            args.min_string_len,
+            chunk_bytes=args.string_chunk_bytes,
+            byte_budget=args.string_byte_budget,
+            xor_bytes=args.xor_byte_budget if args.xor_strings else None,
+        )
+    features = {
+        "head": head,
+        "tail": tail,
+        "size": size,
+        "ext": file_extension(path),
+        "magic": magic,
+        "strings": strings,
+    }
+    if args.structure:
+        with timed("structure"):
+            features["structure"] = parse_executable(path)
+    if args.entropy and np is not None:
+        with timed("entropy", size):
+            features["entropy"] = entropy_profile(path, args)
+    if args.ngram_size > 0 and np is not None:
+        with timed("ngrams"):
+            data = read_ngram_sample(path, args.ngram_byte_budget)
+            hashes, _ = winnowed_ngrams(data, args.ngram_size, args.ngram_window)
+            features["ngrams"] = distinct_hashes(hashes).astype("<u8").tobytes()
+        if clock is not None:
+            clock.add("ngrams", nbytes=len(data))
+    if wants_minhash(args):
+        with timed("minhash"):
+            # With n-grams, half the signature covers them so that their much
+            # larger sets do not swamp the strings; slot agreement then
+            # averages the two.
+            string_hashes = [string_hash(s) for s in features["strings"]]
+            if "ngrams" in features:
+                packed = features["ngrams"]
+                ngram_set = struct.unpack(f"<{len(packed) // 8}Q", packed)
+                half = args.minhash_perms // 2
+                features["minhash"] = minhash_signature(
+                    string_hashes, half
+                ) + minhash_signature(ngram_set, args.minhash_perms - half)
+            else:
+                features["minhash"] = minhash_signature(
+                    string_hashes, args.minhash_perms
+                )
+    if clock is not None:
+        clock.add("read", nbytes=min(size, len(head) + len(tail)))
+        features["stats"] = clock.phases
+    return features
+
+
+def _extract_run(
+    paths: Sequence[pathlib.Path], args: argparse.Namespace
+) -> Iterator[dict]:
+    prefetched = prefetch_head_tail(paths, args)
+    for path in paths:
+        clock = PhaseTimes() if args.stats else None
+        # With prefetching, "read" is the time spent waiting for the result.
+        with clock.phase("read") if clock is not None else _untimed("read"):
+            head_tail = next(prefetched)
+        yield extract_features(path, args, head_tail, clock)
+
+
+def _extract_chunk(paths: Sequence[pathlib.Path], args: argparse.Namespace) -> list[dict]:
+    return list(_extract_run(paths, args))
+
+
+def _extract_many(
+    paths: Sequence[pathlib.Path], args: argparse.Namespace
+) -> Iterator[dict]:
+    # Workers get whole chunks, so each one prefetches within its own chunk
+    # (Executor.map would drain a prefetching iterator in the parent at once).
+    extract = functools.partial(_extract_chunk, args=args)
+    yield from pool_map(extract, paths, args, batched=True)
+
+
+def iter_features(
+    paths: Sequence[pathlib.Path], args: argparse.Namespace
+) -> Iterator[dict]:
+    """Yield per-file features in the same order as ``paths``.
+
+    With ``--jobs`` other than 1 the extraction runs in a process pool and only
+    the compact per-file results travel back to the parent. With ``--cache``
+    unchanged files are loaded from the cache and only the rest are extracted.
+    """
+    if not args.cache:
+        for path, features in zip(paths, _extract_many(paths, args)):
+            if _RUN_STATS is not None:
+                _RUN_STATS.add_file(path, features)
+            yield features
+        return
+
+    cache = FeatureCache(args.cache, feature_cache_params(args))
+    try:
+        stats = [sample_stat(path) for path in paths]
+        missing = [
+            i for i, (path, st) in enumerate(zip(paths, stats)) if not cache.has(path, st)
+        ]
+        fresh = _extract_many([paths[i] for i in missing], args)
+        missing_set = set(missing)
+        for i, path in enumerate(paths):
+            if i in missing_set:
+                features = next(fresh)
+                if _RUN_STATS is not None:
+                    _RUN_STATS.add_file(path, features)
+                cache.store(path, stats[i], features)
+            else:
+                features = cache.load(path)
+                if _RUN_STATS is not None:
+                    _RUN_STATS.add_file(path, features)
+            yield features
+    finally:
+        cache.close()
+
+
+def feature_cache_params(args: argparse.Namespace) -> str:
+    """Describe the options that shape extracted features, for cache keys."""
+    return json.dumps(
+        {
+            "version": FEATURE_CACHE_VERSION,
+            "head_bytes": args.head_bytes,
+            "tail_bytes": args.tail_bytes,
+            "min_string_len": args.min_string_len,
+            "string_chunk_bytes": args.string_chunk_bytes,
+            "string_byte_budget": args.string_byte_budget,
+            "xor_bytes": args.xor_byte_budget if args.xor_strings else None,
+            "ngram_size": args.ngram_size,
+            "ngram_window": args.ngram_window,
+            "ngram_byte_budget": args.ngram_byte_budget,
+            "minhash_perms": args.minhash_perms if wants_minhash(args) else 0,
+            "structure": args.structure,
+            "entropy": (
+                [
+                    args.entropy_window,
+                    args.entropy_step,
+                    args.high_entropy,
+                    args.entropy_time_budget,
+                ]
+                if args.entropy
+                else None
+            ),
+        },
+        sort_keys=True,
+    )
+
+
+class FeatureCache:
+    """SQLite store of per-file features, keyed by path, size and mtime_ns.
+
+    Rows are also keyed by the extraction options, so changing e.g.
+    ``--head-bytes`` re-extracts instead of reusing features of another shape.
+    Features are stored as zlib-compressed ``marshal`` blobs.
+    """
+
+    def __init__(self, db_path: str, params: str):
+        self.params = params
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS features ("
+            " path TEXT NOT NULL,"
+            " params TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " data BLOB NOT NULL,"
+            " PRIMARY KEY (path, params))"
+        )
+        self._pending = 0
+
+    def has(self, path: pathlib.Path, st: os.stat_result) -> bool:
+        row = self.conn.execute(
+            "SELECT 1 FROM features"
+            " WHERE path = ? AND params = ? AND size = ? AND mtime_ns = ?",
+            (str(path), self.params, st.st_size, st.st_mtime_ns),
+        ).fetchone()
+        return row is not None
+
+    def load(self, path: pathlib.Path) -> dict:
+        (data,) = self.conn.execute(
+            "SELECT data FROM features WHERE path = ? AND params = ?",
+            (str(path), self.params),
+        ).fetchone()
+        return marshal.loads(zlib.decompress(data))
+
+    def store(self, path: pathlib.Path, st: os.stat_result, features: dict) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?)",
+            (
+                str(path),
+                self.params,
+                st.st_size,
+                st.st_mtime_ns,
+                zlib.compress(marshal.dumps(features), 1),
+            ),
+        )
+        self._pending += 1
+        if self._pending >= 1000:
+            self.conn.commit()
+            self._pending = 0
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+
+
+class ColumnAccumulator:
+    """Incrementally track per-offset byte agreement over a stream of chunks.
+
+    State is kept per offset only: the byte the first chunk held there, whether
+    every later chunk still agrees, and optionally a byte histogram. Chunks are
+    folded in small batches, so memory is O(width) however many chunks stream
+    past. With ``from_end``, offset 0 is the last byte of each chunk.
+
+    When ``histogram`` is set, ``counts[offset][value]`` counts the chunks that
+    held ``value`` at ``offset``; column 256 counts chunks too short to reach it.
+    """
+
+    def __init__(self, width: int, from_end: bool = False, histogram: bool = False):
+        self.width = width
+        self.from_end = from_end
+        self.count = 0
+        self.limit = width
+        self.first = b""
+        self.agree = None
+        self.counts = None
+        if histogram:
+            if np is None:
+                self.counts = [[0] * 257 for _ in range(width)]
+            else:
+                self.counts = np.zeros((width, 257), dtype=np.int64)
+        self._pending: list[bytes] = []
+        self._batch_rows = max(1, CONSENSUS_BLOCK_BYTES // max(width, 1))
+
+    def add(self, chunk: bytes) -> None:
+        row = chunk[::-1][: self.width] if self.from_end else chunk[: self.width]
+        if self.count == 0:
+            self.first = row
+            if np is None:
+                self.agree = bytearray(b"\x01" * len(row))
+            else:
+                self.agree = np.ones(len(row), dtype=bool)
+        self.count += 1
+        self.limit = min(self.limit, len(row))
+        self._pending.append(row)
+        if len(self._pending) >= self._batch_rows:
+            self._fold()
+
+    def result(self) -> tuple[bytes, bytes]:
+        """Return ``(values, agree)`` over the offsets every chunk reached."""
+        self._fold()
+        if self.count == 0:
+            return b"", b""
+        agree = self.agree if np is None else self.agree.astype(np.uint8).tobytes()
+        return self.first[: self.limit], bytes(agree[: self.limit])
+
+    def quorum_result(self, quorum: float) -> tuple[bytes, bytes, list[float]]:
+        """Return ``(values, agree, support)`` from the per-offset histograms.
+
+        ``values[i]`` is the most common byte at offset ``i``, ``support[i]`` the
+        fraction of all chunks holding it, and ``agree[i]`` is 1 when that
+        fraction reaches ``quorum``. Chunks too short to reach an offset count
+        as absent there instead of cutting every offset off at the shortest one.
+        """
+        self._fold()
+        if self.counts is None:
+            raise ValueError("quorum_result() needs histogram=True")
+        if self.count == 0:
+            return b"", b"", []
+        needed = max(1, math.ceil(self.count * quorum))
+
+        if np is None:
+            modal = []
+            hits = []
+            for row in self.counts:
+                value = max(range(256), key=row.__getitem__)
+                modal.append(value)
+                hits.append(row[value])
+        else:
+            present = self.counts[:, :256]
+            modal = present.argmax(axis=1).tolist()
+            hits = present.max(axis=1).tolist()
+
+        reach = len(hits)
+        while reach and not hits[reach - 1]:
+            reach -= 1
+        values = bytes(modal[:reach])
+        agree = bytes(1 if h >= needed else 0 for h in hits[:reach])
+        support = [h / self.count for h in hits[:reach]]
+        return values, agree, support
+
+    def _fold(self) -> None:
+        rows, self._pending = self._pending, []
+        if not rows:
+            return
+        limit = self.limit
+        self.agree = self.agree[:limit]
+
+        if np is None:
+            live = [i for i in range(limit) if self.agree[i]]
+            for row in rows:
+                if not live:
+                    break
+                live = [i for i in live if row[i] == self.first[i]]
+            self.agree = bytearray(limit)
+            for i in live:
+                self.agree[i] = 1
+            if self.counts is not None:
+                for row in rows:
+                    for i, value in enumerate(row):
+                        self.counts[i][value] += 1
+                    for i in range(len(row), self.width):
+                        self.counts[i][256] += 1
+            return
+
+        if limit and self.agree.any():
+            matrix = np.frombuffer(
+                b"".join(row[:limit] for row in rows), dtype=np.uint8
+            ).reshape(len(rows), limit)
+            first = np.frombuffer(self.first[:limit], dtype=np.uint8)
+            self.agree &= (matrix == first).all(axis=0)
+        if self.counts is not None and self.width:
+            # Offsets a row does not reach land in bin 256 ("absent").
+            bins = np.arange(self.width, dtype=np.int32) * 257
+            step = max(1, CONSENSUS_BLOCK_BYTES // (4 * self.width))
+            for start in range(0, len(rows), step):
+                block = rows[start : start + step]
+                padded = np.full((len(block), self.width), 256, dtype=np.int32)
+                for i, row in enumerate(block):
+                    padded[i, : len(row)] = np.frombuffer(row, dtype=np.uint8)
+                padded += bins
+                self.counts += np.bincount(
+                    padded.ravel(), minlength=self.width * 257
+                ).reshape(self.width, 257)
+
+
+def column_consensus(
+    chunks: Sequence[bytes], from_end: bool = False, max_len: int | None = None
+) -> tuple[bytes, bytes]:
+    """Compute per-offset agreement across ``chunks`` in a single pass.
+
+    Returns ``(values, agree)``: ``values[i]`` is the byte the first chunk holds
+    at offset ``i`` and ``agree[i]`` is 1 when every chunk holds that same byte.
+    Offsets run up to the shortest chunk (or ``max_len``). With ``from_end``,
+    offset 0 is the last byte of each chunk, offset 1 the one before it, etc.
+    """
+    if not chunks:
+        return b"", b""
+    width = max(len(c) for c in chunks)
+    if max_len is not None:
+        width = min(width, max_len)
+    accumulator = ColumnAccumulator(width, from_end=from_end)
+    for chunk in chunks:
+        accumulator.add(chunk)
+    return accumulator.result()
+
+
+def agreed_runs(agree: bytes, min_run: int = 1) -> list[tuple[int, int]]:
+    """Return ``(offset, length)`` for each run of agreeing offsets."""
+    return [
+        (m.start(), m.end() - m.start())
+        for m in re.finditer(rb"\x01+", agree)
+        if m.end() - m.start() >= min_run
+    ]
+
+
+def leading_agreement(values: bytes, agree: bytes) -> bytes:
+    return values[: len(agree) - len(agree.lstrip(b"\x01"))]
+
+
+def runs_from_columns(
+    values: bytes,
+    agree: bytes,
+    min_run: int,
+    from_end: bool = False,
+    support: Sequence[float] | None = None,
+) -> list[dict]:
+    runs = []
+    for offset, length in agreed_runs(agree, min_run):
+        data = values[offset : offset + length]
+        if from_end:
+            data = data[::-1]
+        run = {
+            "offset_from_end" if from_end else "offset": offset,
+            "length": length,
+            "hex": data.hex(" ").upper(),
+            "ascii": printable_preview(data),
+        }
+        if support is not None:
+            run["min_support"] = round(min(support[offset : offset + length]), 4)
+        runs.append(run)
+    return runs
+
+
+def yara_mask_from_columns(values: bytes, agree: bytes, window: int) -> str:
+    tokens: list[str] = []
+    wildcard_run = 0
+
+    def flush_wildcards():
+        nonlocal wildcard_run, tokens
+        if wildcard_run == 0:
+            return
+        if wildcard_run <= 2:
+            tokens.extend(["??"] * wildcard_run)
+        else:
+            tokens.append(f"[{wildcard_run}]")
+        wildcard_run = 0
+
+    for value, ok in zip(values[:window], agree[:window]):
+        if ok:
+            flush_wildcards()
+            tokens.append(f"{value:02X}")
+        else:
+            wildcard_run += 1
+
+    flush_wildcards()
+    return "{ " + " ".join(tokens) + " }"
+
+
+def common_prefix(chunks: Sequence[bytes]) -> bytes:
+    return leading_agreement(*column_consensus(chunks))
+
+
+def printable_preview(data: bytes, max_len: int = 64) -> str:
+    out = []
+    for b in data[:max_len]:
+        if 32 <= b <= 126:
+            out.append(chr(b))
+        else:
+            out.append(".")
+    s = "".join(out)
+    if len(data) > max_len:
+        s += "..."
+    return s
+
+
+def top_items(counter: collections.Counter, top_n: int) -> list[dict]:
+    items = []
+    for value, count in counter.most_common(top_n):
+        items.append({"value": value, "count": count})
+    return items
+
+
+_MAGIC_CLASSIFIERS: tuple | None = None
+
+
+def _magic_classifiers() -> tuple:
+    """Return this process's ``(mime, description)`` libmagic instances, created
+    on first use, or an empty tuple if python-magic is unavailable."""
+    global _MAGIC_CLASSIFIERS
+    if _MAGIC_CLASSIFIERS is None:
+        try:
+            import magic  # type: ignore
+
+            _MAGIC_CLASSIFIERS = (magic.Magic(mime=True), magic.Magic(mime=False))
+        except Exception:
+            _MAGIC_CLASSIFIERS = ()
+    return _MAGIC_CLASSIFIERS
+
+
+def try_magic(data: bytes) -> tuple[str, str]:
+    """Classify already-read header bytes; return ``(mime, description)``, with
+    empty strings where libmagic is unavailable or fails."""
+    results = []
+    for classifier in _magic_classifiers():
+        try:
+            results.append(classifier.from_buffer(data) or "")
+        except Exception:
+            results.append("")
+    return (results[0], results[1]) if results else ("", "")
+
+
+class StringHeavyHitters:
+    """Misra-Gries summary of per-file string counts with a bounded key set.
+
+    At most about ``2 * capacity`` strings are tracked. When the table fills up,
+    the (capacity+1)-th largest count is subtracted from every entry and the
+    entries that drop to zero are forgotten. Each reported count is therefore a
+    lower bound that is low by at most ``max_undercount``, itself at most
+    ``total / (capacity + 1)``, and every string whose true count exceeds
+    ``max_undercount`` is still tracked.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: dict[str, int] = {}
+        self.max_undercount = 0
+        self.total = 0
+
+    def update(self, strings: Iterable[str]) -> None:
+        counts = self.counts
+        for s in strings:
+            counts[s] = counts.get(s, 0) + 1
+            self.total += 1
+        if len(counts) > 2 * self.capacity:
+            cut = heapq.nlargest(self.capacity + 1, counts.values())[-1]
+            self.counts = {s: c - cut for s, c in counts.items() if c > cut}
+            self.max_undercount += cut
+
+    def items(self):
+        return self.counts.items()
+
+
+class StringOffsetStats:
+    """Where each candidate string first occurs, aggregated over files.
+
+    Per string it keeps ``[files, min, max, min_from_end, max_from_end]`` of
+    the first-occurrence offset. Only strings the caller still considers
+    candidates are tracked; ``prune`` drops the rest.
+    """
+
+    def __init__(self):
+        self.stats: dict[str, list[int]] = {}
+
+    def update(self, strings: dict[str, int], size: int, keep) -> None:
+        stats = self.stats
+        for s, offset in strings.items():
+            if not keep(s):
+                continue
+            from_end = size - offset
+            entry = stats.get(s)
+            if entry is None:
+                stats[s] = [1, offset, offset, from_end, from_end]
+                continue
+            entry[0] += 1
+            if offset < entry[1]:
+                entry[1] = offset
+            if offset > entry[2]:
+                entry[2] = offset
+            if from_end < entry[3]:
+                entry[3] = from_end
+            if from_end > entry[4]:
+                entry[4] = from_end
+
+    def prune(self, keep) -> None:
+        self.stats = {s: entry for s, entry in self.stats.items() if keep(s)}
+
+    def summary(self, s: str, count: int, max_range: int) -> dict | None:
+        """Offset statistics for ``s`` plus a suggested position condition, or
+        None if the string was not tracked in all ``count`` files."""
+        entry = self.stats.get(s)
+        if entry is None or entry[0] < count:
+            return None
+        files, low, high, end_low, end_high = entry
+        if low == high:
+            condition = f"at 0x{low:X}"
+        elif end_low == end_high:
+            condition = f"at filesize - 0x{end_low:X}"
+        elif high - low <= min(end_high - end_low, max_range):
+            condition = f"in (0x{low:X}..0x{high:X})"
+        elif end_high - end_low <= max_range:
+            condition = f"in (filesize - 0x{end_high:X}..filesize - 0x{end_low:X})"
+        else:
+            condition = ""
+        return {
+            "min": low,
+            "max": high,
+            "min_from_end": end_low,
+            "max_from_end": end_high,
+            "fixed": low == high,
+            "condition": condition,
+        }
+
+
+class SizeStats:
+    """Minimum, maximum, mean and median of the sample sizes.
+
+    Memory does not grow with the file count: sizes are counted exactly until
+    ``SIZE_EXACT_VALUES`` distinct values have been seen, then folded into
+    log-scale bins, so the median is exact for small corpora and within about
+    one percent otherwise.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+        self.counts: collections.Counter = collections.Counter()
+        self.binned = False
+
+    @staticmethod
+    def _bin(size: int) -> int:
+        return round(math.log2(size) * SIZE_BINS_PER_OCTAVE) if size > 0 else -1
+
+    def _value(self, key: int) -> float:
+        if not self.binned:
+            return key
+        return 2 ** (key / SIZE_BINS_PER_OCTAVE) if key >= 0 else 0
+
+    def add(self, size: int) -> None:
+        if not self.count or size < self.min:
+            self.min = size
+        if not self.count or size > self.max:
+            self.max = size
+        self.count += 1
+        self.total += size
+        self.counts[self._bin(size) if self.binned else size] += 1
+        if not self.binned and len(self.counts) > SIZE_EXACT_VALUES:
+            binned: collections.Counter = collections.Counter()
+            for value, n in self.counts.items():
+                binned[self._bin(value)] += n
+            self.counts = binned
+            self.binned = True
+
+    def median(self) -> float:
+        """Average of the two middle values, like ``statistics.median``."""
+        middle = [(self.count - 1) // 2, self.count // 2]
+        values = []
+        seen = 0
+        for key in sorted(self.counts):
+            seen += self.counts[key]
+            while middle and middle[0] < seen:
+                middle.pop(0)
+                values.append(min(max(self._value(key), self.min), self.max))
+            if not middle:
+                break
+        return sum(values) / 2
+
+    def result(self) -> dict:
+        if not self.count:
+            return {"min": 0, "max": 0, "mean": 0, "median": 0}
+        return {
+            "min": self.min,
+            "max": self.max,
+            "mean": round(self.total / self.count, 2),
+            "median": int(self.median()),
+        }
+
+
+class HashDocumentFrequency:
+    """Misra-Gries document frequency over 64-bit hashes, in NumPy.
+
+    Per-file hash sets are buffered and merged in batches with ``np.unique``.
+    After a merge the table is cut back to ``capacity`` entries the same way
+    ``StringHeavyHitters`` does, so counts are lower bounds that are low by at
+    most ``max_undercount``. A ``capacity`` of 0 counts exactly.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.max_undercount = 0
+        self._pending: list = []
+        self._pending_size = 0
+
+    def update(self, packed: bytes) -> None:
+        """Count one file's distinct hashes, packed as little-endian uint64."""
+        hashes = np.frombuffer(packed, dtype="<u8")
+        self._pending.append(hashes)
+        self._pending_size += len(hashes)
+        if self._pending_size >= min(
+            self.capacity or HASH_MERGE_BATCH, HASH_MERGE_BATCH
+        ):
+            self.merge()
+
+    def frequent(self, threshold: int) -> dict[int, int]:
+        """Return ``{hash: count}`` for hashes that may reach ``threshold``."""
+        self.merge()
+        mask = self.counts + self.max_undercount >= threshold
+        return dict(zip(self.keys[mask].tolist(), self.counts[mask].tolist()))
+
+    def merge(self) -> None:
+        if not self._pending:
+            return
+        pending = np.concatenate(self._pending)
+        self._pending = []
+        self._pending_size = 0
+        keys, inverse = np.unique(
+            np.concatenate([self.keys, pending]), return_inverse=True
+        )
+        weights = np.concatenate([self.counts, np.ones(len(pending), np.int64)])
+        counts = np.bincount(inverse, weights=weights).astype(np.int64)
+        if self.capacity and len(keys) > 2 * self.capacity:
+            cut = int(np.partition(counts, len(counts) - self.capacity - 1)[
+                len(counts) - self.capacity - 1
+            ])
+            keep = counts > cut
+            keys, counts = keys[keep], counts[keep] - cut
+            self.max_undercount += cut
+        self.keys, self.counts = keys, counts
+
+
+def string_hash(s: str) -> int:
+    """Stable 64-bit hash of a string, used as its key in background indexes."""
+    return int.from_bytes(
+        hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+class BackgroundIndex:
+    """Read-only, memory-mapped index of string and n-gram document counts.
+
+    Built from a clean (goodware) corpus with ``--build-background-index``.
+    The file holds a fixed header followed by sorted uint64 key arrays and
+    their uint32 counts, so lookups are a binary search over the mapping and
+    nothing is loaded up front:
+
+        header  BACKGROUND_INDEX_HEADER (magic, files, #strings, #ngrams,
+                ngram size, ngram window)
+        u64[#strings] string hashes    u64[#ngrams] n-gram hashes
+        u32[#strings] string counts    u32[#ngrams] n-gram counts
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic_bytes,
+            self.file_count,
+            self.string_total,
+            self.ngram_total,
+            self.ngram_size,
+            self.ngram_window,
+        ) = BACKGROUND_INDEX_HEADER.unpack_from(self._mm, 0)
+        if magic_bytes != BACKGROUND_INDEX_MAGIC:
+            raise ValueError(f"{path} is not a background index")
+        base = BACKGROUND_INDEX_HEADER.size
+        self._string_keys = base
+        self._ngram_keys = self._string_keys + 8 * self.string_total
+        self._string_counts = self._ngram_keys + 8 * self.ngram_total
+        self._ngram_counts = self._string_counts + 4 * self.string_total
+
+    def string_counts(self, strings: Sequence[str]) -> list[int]:
+        return self._lookup(
+            [string_hash(s) for s in strings],
+            self._string_keys,
+            self._string_counts,
+            self.string_total,
+        )
+
+    def ngram_counts(self, hashes: Sequence[int]) -> list[int]:
+        return self._lookup(
+            hashes, self._ngram_keys, self._ngram_counts, self.ngram_total
+        )
+
+    def _lookup(
+        self, hashes: Sequence[int], keys_at: int, counts_at: int, total: int
+    ) -> list[int]:
+        if not total or not len(hashes):
+            return [0] * len(hashes)
+        if np is not None:
+            keys = np.frombuffer(self._mm, dtype="<u8", count=total, offset=keys_at)
+            counts = np.frombuffer(self._mm, dtype="<u4", count=total, offset=counts_at)
+            wanted = np.asarray(hashes, dtype=np.uint64)
+            idx = np.minimum(np.searchsorted(keys, wanted), total - 1)
+            return np.where(keys[idx] == wanted, counts[idx], 0).tolist()
+
+        out = []
+        for h in hashes:
+            lo, hi = 0, total
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if struct.unpack_from("<Q", self._mm, keys_at + 8 * mid)[0] < h:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            found = (
+                lo < total
+                and struct.unpack_from("<Q", self._mm, keys_at + 8 * lo)[0] == h
+            )
+            out.append(
+                struct.unpack_from("<I", self._mm, counts_at + 4 * lo)[0] if found else 0
+            )
+        return out
+
+    def close(self) -> None:
+        self._mm.close()
+        self._file.close()
+
+
+def build_background_index(
+    paths: Sequence[pathlib.Path], args: argparse.Namespace
+) -> dict:
+    """Count string and n-gram document frequency over a clean corpus and
+    write them as a ``BackgroundIndex`` file."""
+    strings = HashDocumentFrequency(0)
+    ngrams = HashDocumentFrequency(0)
+    for features in iter_features(paths, args):
+        keys = np.fromiter(
+            (string_hash(s) for s in features["strings"]),
+            dtype="<u8",
+            count=len(features["strings"]),
+        )
+        strings.update(distinct_hashes(keys).tobytes())
+        if "ngrams" in features:
+            ngrams.update(features["ngrams"])
+    strings.merge()
+    ngrams.merge()
+
+    with open(args.build_background_index, "wb") as f:
+        f.write(
+            BACKGROUND_INDEX_HEADER.pack(
+                BACKGROUND_INDEX_MAGIC,
+                len(paths),
+                len(strings.keys),
+                len(ngrams.keys),
+                args.ngram_size,
+                args.ngram_window,
+            )
+        )
+        f.write(strings.keys.astype("<u8").tobytes())
+        f.write(ngrams.keys.astype("<u8").tobytes())
+        f.write(np.minimum(strings.counts, 0xFFFFFFFF).astype("<u4").tobytes())
+        f.write(np.minimum(ngrams.counts, 0xFFFFFFFF).astype("<u4").tobytes())
+
+    return {
+        "file_count": len(paths),
+        "strings": len(strings.keys),
+        "ngrams": len(ngrams.keys),
+    }
+
+
+def _informative_ngrams(data: bytes, positions: "np.ndarray", n: int) -> "np.ndarray":
+    """Mask of the n-grams at ``positions`` that are not filler.
+
+    As in the XOR engine, bytes that are NUL or repeat one of the previous two
+    bytes mark padding and tables; an n-gram that is half or more such bytes
+    (a run of one byte, zero padding, a two-byte pattern) is dropped.
+    """
+    if not len(positions):
+        return np.zeros(0, dtype=bool)
+    raw = np.frombuffer(data, dtype=np.uint8)
+    grams = np.lib.stride_tricks.sliding_window_view(raw, n)[positions]
+    zeros = (grams == 0).sum(axis=1)
+    repeated = np.zeros(grams.shape, dtype=bool)
+    repeated[:, 1:] = grams[:, 1:] == grams[:, :-1]
+    repeated[:, 2:] |= grams[:, 2:] == grams[:, :-2]
+    return (2 * zeros < n) & (2 * repeated.sum(axis=1) < n)
+
+
+def _frequent_ngrams(
+    data: bytes, wanted: "np.ndarray", args: argparse.Namespace
+) -> tuple[list[int], list[int]]:
+    """Winnowed positions of the informative n-grams of ``data`` in ``wanted``."""
+    n = args.ngram_size
+    hashes, positions = winnowed_ngrams(data, n, args.ngram_window)
+    mask = np.isin(hashes, wanted)
+    hashes, positions = hashes[mask], positions[mask]
+    keep = _informative_ngrams(data, positions, n)
+    return hashes[keep].tolist(), positions[keep].tolist()
+
+
+def shared_byte_sequences(
+    paths: Sequence[pathlib.Path],
+    frequent: dict[int, int],
+    args: argparse.Namespace,
+    background: BackgroundIndex | None = None,
+) -> list[dict]:
+    """Expand frequent n-gram hashes back into maximal shared byte sequences.
+
+    Only the first ``NGRAM_MAX_REPRESENTATIVES`` files are re-read, three
+    times each:
+
+    1. note which representatives hold each frequent, informative n-gram;
+    2. merge the positions of consecutive n-grams that overlap or touch into
+       spans, but only while all of a span's n-grams still occur together in
+       the representative share that ``--string-presence`` asks for;
+    3. search the best ``2 * --top-ngrams`` spans byte for byte in every
+       representative and report how many actually contain them (``files``
+       of ``checked_files``), leaving out pieces of longer reported spans.
+       ``min_ngram_df``, the smallest corpus document frequency among a
+       span's n-grams, is only an upper bound for the span.
+
+    With a compatible ``background`` index, each span also gets an upper bound
+    on how many goodware files contain it, and spans above
+    ``--max-background-fraction`` are dropped.
+    """
+    if not frequent:
+        return []
+    n = args.ngram_size
+    wanted = np.fromiter(frequent.keys(), dtype=np.uint64, count=len(frequent))
+    representatives = paths[:NGRAM_MAX_REPRESENTATIVES]
+    need = max(1, math.ceil(len(representatives) * args.string_presence))
+
+    # Which representatives hold each n-gram, as a bit mask.
+    holders: dict[int, int] = collections.defaultdict(int)
+    for bit, path in enumerate(representatives):
+        data = read_ngram_sample(path, args.ngram_byte_budget)
+        hashes, _ = _frequent_ngrams(data, wanted, args)
+        for h in set(hashes):
+            holders[h] |= 1 << bit
+
+    sequences: dict[bytes, dict] = {}
+    for path in representatives:
+        data = read_ngram_sample(path, args.ngram_byte_budget)
+        hashes, positions = _frequent_ngrams(data, wanted, args)
+        spans: list[list] = []
+        for h, pos in zip(hashes, positions):
+            if spans and pos <= spans[-1][1]:
+                shared = spans[-1][3] & holders[h]
+                if shared.bit_count() >= need:
+                    spans[-1][1] = pos + n
+                    spans[-1][2] = min(spans[-1][2], frequent[h])
+                    spans[-1][3] = shared
+                    continue
+            spans.append([pos, pos + n, frequent[h], holders[h]])
+
+        for start, end, support, shared in spans:
+            if shared.bit_count() < need:
+                continue
+            data_span = data[start:end]
+            if data_span not in sequences:
+                sequences[data_span] = {
+                    "length": end - start,
+                    "min_ngram_df": support,
+                    "example_file": str(path),
+                    "example_offset": start,
+                    "hex": data_span[:NGRAM_HEX_PREVIEW].hex(" ").upper()
+                    + (" ..." if end - start > NGRAM_HEX_PREVIEW else ""),
+                    "ascii": printable_preview(data_span),
+                    "_holders": shared.bit_count(),
+                }
+
+    if (
+        background is not None
+        and background.ngram_size == n
+        and background.ngram_window == args.ngram_window
+    ):
+        for data_span, item in list(sequences.items()):
+            span_hashes, _ = winnowed_ngrams(data_span, n, args.ngram_window)
+            bg_count = min(background.ngram_counts(span_hashes.tolist()), default=0)
+            fraction = bg_count / background.file_count if background.file_count else 0.0
+            if fraction > args.max_background_fraction:
+                del sequences[data_span]
+                continue
+            item["background_count"] = bg_count
+            item["background_fraction"] = round(fraction, 4)
+
+    candidates = sorted(
+        sequences.items(),
+        key=lambda kv: (-kv[1]["_holders"], -kv[1]["length"], kv[1]["example_offset"]),
+    )[: 2 * args.top_ngrams]
+    for _, item in candidates:
+        del item["_holders"]
+        item["files"] = 0
+        item["checked_files"] = len(representatives)
+    for path in representatives:
+        data = read_ngram_sample(path, args.ngram_byte_budget)
+        for data_span, item in candidates:
+            if data_span in data:
+                item["files"] += 1
+
+    ranked: list[tuple[bytes, dict]] = []
+    for data_span, item in sorted(
+        candidates,
+        key=lambda kv: (-kv[1]["files"], -kv[1]["length"], kv[1]["example_offset"]),
+    ):
+        if item["files"] < need:
+            continue
+        # A piece of a span already reported for as many files adds nothing.
+        if any(
+            data_span in other and item["files"] <= other_item["files"]
+            for other, other_item in ranked
+        ):
+            continue
+        ranked.append((data_span, item))
+    return [item for _, item in ranked[: args.top_ngrams]]
+
+
+def _mix64(x: int) -> int:
+    """splitmix64 finalizer on Python ints."""
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+
+def minhash_seeds(count: int) -> list[int]:
+    return [_mix64(i + 1) for i in range(count)]
+
+
+def minhash_signature(elements: Sequence[int], perms: int) -> bytes:
+    """MinHash of a set of 64-bit element hashes, packed as little-endian uint64.
+
+    Each permutation is the splitmix64 finalizer applied to ``element ^ seed``;
+    the NumPy and pure-Python paths produce identical signatures.
+    """
+    seeds = minhash_seeds(perms)
+    if not len(elements):
+        return struct.pack(f"<{perms}Q", *([MASK64] * perms))
+
+    if np is None:
+        return struct.pack(
+            f"<{perms}Q", *(min(_mix64(x ^ seed) for x in elements) for seed in seeds)
+        )
+
+    values = np.asarray(elements, dtype=np.uint64)
+    seed_arr = np.asarray(seeds, dtype=np.uint64)[:, None]
+    signature = np.full(perms, MASK64, dtype=np.uint64)
+    step = max(1, MINHASH_BLOCK_CELLS // perms)
+    for start in range(0, len(values), step):
+        z = values[None, start : start + step] ^ seed_arr
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z ^= z >> np.uint64(31)
+        signature = np.minimum(signature, z.min(axis=1))
+    return signature.astype("<u8").tobytes()
+
+
+def minhash_similarity(a: bytes, b: bytes) -> float:
+    """Estimated Jaccard similarity: the fraction of equal signature slots."""
+    if np is not None:
+        return float(
+            np.count_nonzero(np.frombuffer(a, "<u8") == np.frombuffer(b, "<u8"))
+        ) / (len(a) // 8)
+    pairs = zip(struct.iter_unpack("<Q", a), struct.iter_unpack("<Q", b))
+    return sum(x == y for x, y in pairs) / (len(a) // 8)
+
+
+def cluster_samples(
+    paths: Sequence[pathlib.Path], args: argparse.Namespace
+) -> tuple[list[list[pathlib.Path]], list[pathlib.Path]]:
+    """Group samples by MinHash/LSH over their string and n-gram sets.
+
+    Signatures are cut into ``--lsh-bands`` bands; files landing in the same
+    bucket of any band are joined (union-find) when their estimated Jaccard
+    similarity to the bucket's first file reaches ``--cluster-threshold``.
+    Each file is compared against at most one file per band, so the cost is
+    linear in the number of files. Returns ``(clusters, unclustered)``, with
+    clusters smaller than ``--min-cluster-size`` counted as unclustered.
+    """
+    signatures = []
+    index = SimilarityIndex(args.similarity_index) if args.similarity_index else None
+    for path, features in zip(paths, iter_features(paths, args)):
+        signatures.append(features["minhash"])
+        if index is not None:
+            index.add(path, features, args.lsh_bands)
+    if index is not None:
+        index.close()
+    parent = list(range(len(paths)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    band_bytes = 8 * (args.minhash_perms // args.lsh_bands)
+    for band in range(args.lsh_bands):
+        start = band * band_bytes
+        buckets: dict[bytes, int] = {}
+        for i, signature in enumerate(signatures):
+            first = buckets.setdefault(signature[start : start + band_bytes], i)
+            if first == i:
+                continue
+            a, b = find(i), find(first)
+            if a != b and (
+                minhash_similarity(signature, signatures[first])
+                >= args.cluster_threshold
+            ):
+                parent[a] = b
+
+    groups: dict[int, list[pathlib.Path]] = collections.defaultdict(list)
+    for i, path in enumerate(paths):
+        groups[find(i)].append(path)
+    clusters = []
+    unclustered = []
+    for members in groups.values():
+        if len(members) >= args.min_cluster_size:
+            clusters.append(members)
+        else:
+            unclustered.extend(members)
+    clusters.sort(key=lambda members: (-len(members), str(members[0])))
+    return clusters, sorted(unclustered)
+
+
+def wants_minhash(args: argparse.Namespace) -> bool:
+    return bool(args.cluster or args.similarity_index or args.query_index)
+
+
+def similarity_params(args: argparse.Namespace) -> dict:
+    """Options that shape MinHash signatures; an index and its queries must agree."""
+    return {
+        "min_string_len": args.min_string_len,
+        "string_chunk_bytes": args.string_chunk_bytes,
+        "string_byte_budget": args.string_byte_budget,
+        "ngram_size": args.ngram_size if np is not None else 0,
+        "ngram_window": args.ngram_window,
+        "ngram_byte_budget": args.ngram_byte_budget,
+        "minhash_perms": args.minhash_perms,
+        "lsh_bands": args.lsh_bands,
+        "xor_strings": args.xor_strings,
+        "xor_byte_budget": args.xor_byte_budget if args.xor_strings else None,
+    }
+
 
+class SimilarityIndex:
+    """Persistent SQLite index of per-file MinHash signatures for nearest-sample
+    queries.
 
-def iter_files(directory: str, recursive: bool) -> Iterable[pathlib.Path]:
-    root = pathlib.Path(directory)
-    if recursive:
-        for path in root.rglob("*"):
-            if path.is_file():
-                yield path
-    else:
-        for path in root.iterdir():
-            if path.is_file():
-                yield path
+    Every signature is also stored under one LSH key per band, so a query only
+    fetches the samples that share at least one band with it and never scans
+    the whole index. Re-adding a path replaces its old entry.
+    """
 
+    def __init__(self, db_path: str):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);"
+            "CREATE TABLE IF NOT EXISTS samples ("
+            " id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL,"
+            " size INTEGER NOT NULL, signature BLOB NOT NULL, header BLOB NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS bands ("
+            " band INTEGER NOT NULL, key INTEGER NOT NULL, id INTEGER NOT NULL,"
+            " PRIMARY KEY (band, key, id)) WITHOUT ROWID;"
+        )
+        self._pending = 0
 
-def safe_read_head_tail(
-    path: pathlib.Path, head_bytes: int, tail_bytes: int
-) -> tuple[bytes, bytes, int]:
-    size = path.stat().st_size
-    with path.open("rb") as f:
-        head = f.read(head_bytes)
-        if size <= tail_bytes:
-            tail = head if len(head) == size else head + f.read()
+    def params(self) -> dict | None:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'params'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_params(self, params: dict) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('params', ?)", (json.dumps(params),)
+        )
+
+    @staticmethod
+    def band_keys(signature: bytes, bands: int) -> list[int]:
+        width = 8 * (len(signature) // 8 // bands)  # whole uint64 slots per band
+        return [
+            int.from_bytes(
+                hashlib.blake2b(signature[b * width : (b + 1) * width], digest_size=8).digest(),
+                "little",
+                signed=True,
+            )
+            for b in range(bands)
+        ]
+
+    def add(self, path: pathlib.Path, features: dict, bands: int) -> None:
+        signature = features["minhash"]
+        header = features["head"][:SIMILARITY_HEADER_BYTES]
+        row = self.conn.execute(
+            "SELECT id FROM samples WHERE path = ?", (str(path),)
+        ).fetchone()
+        if row:
+            sample_id = row[0]
+            self.conn.execute("DELETE FROM bands WHERE id = ?", (sample_id,))
+            self.conn.execute(
+                "UPDATE samples SET size = ?, signature = ?, header = ? WHERE id = ?",
+                (features["size"], signature, header, sample_id),
+            )
         else:
-            f.seek(max(size - tail_bytes, 0))
-            tail = f.read(tail_bytes)
-    return head, tail, size
+            sample_id = self.conn.execute(
+                "INSERT INTO samples (path, size, signature, header) VALUES (?, ?, ?, ?)",
+                (str(path), features["size"], signature, header),
+            ).lastrowid
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO bands VALUES (?, ?, ?)",
+            [(b, key, sample_id) for b, key in enumerate(self.band_keys(signature, bands))],
+        )
+        self._pending += 1
+        if self._pending >= 1000:
+            self.conn.commit()
+            self._pending = 0
 
+    def query(self, features: dict, bands: int, top_k: int) -> list[dict]:
+        """Return up to ``top_k`` indexed samples most similar to ``features``."""
+        signature = features["minhash"]
+        header = features["head"][:SIMILARITY_HEADER_BYTES]
+        candidates: set[int] = set()
+        for b, key in enumerate(self.band_keys(signature, bands)):
+            candidates.update(
+                row[0]
+                for row in self.conn.execute(
+                    "SELECT id FROM bands WHERE band = ? AND key = ?", (b, key)
+                )
+            )
+        results = []
+        for sample_id in candidates:
+            path, size, other, other_header = self.conn.execute(
+                "SELECT path, size, signature, header FROM samples WHERE id = ?",
+                (sample_id,),
+            ).fetchone()
+            results.append(
+                {
+                    "path": path,
+                    "size": size,
+                    "similarity": round(minhash_similarity(signature, other), 4),
+                    "common_header_bytes": len(
+                        common_prefix([header, bytes(other_header)])
+                    ),
+                }
+            )
+        results.sort(
+            key=lambda item: (-item["similarity"], -item["common_header_bytes"], item["path"])
+        )
+        return results[:top_k]
 
-def extract_strings(path: pathlib.Path, min_len: int) -> set[str]:
-    ascii_re = re.compile(ASCII_PRINTABLE_RE_TEMPLATE % min_len)
-    utf16_re = re.compile(UTF16LE_PRINTABLE_RE_TEMPLATE % min_len)
-    found: set[str] = set()
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
 
-    with path.open("rb") as f:
-        data = f.read()
 
-    for match in ascii_re.finditer(data):
-        try:
-            s = match.group().decode("ascii", errors="ignore").strip()
-            if s:
-                found.add(s)
-        except Exception:
-            pass
+def query_similarity_index(
+    paths: Sequence[pathlib.Path], args: argparse.Namespace
+) -> list[dict]:
+    index = SimilarityIndex(args.query_index)
+    try:
+        bands = args.lsh_bands
+        return [
+            {"query": str(path), "matches": index.query(features, bands, args.top_k)}
+            for path, features in zip(paths, iter_features(paths, args))
+        ]
+    finally:
+        index.close()
 
-    for match in utf16_re.finditer(data):
-        try:
-            raw = match.group()
-            s = raw.decode("utf-16le", errors="ignore").strip()
-            if s:
-                found.add(s)
-        except Exception:
-            pass
 
-    return found
+class StructureSummary:
+    """Aggregate ``parse_executable`` results over the analyzed files."""
 
+    def __init__(self, quorum: float):
+        self.quorum = quorum
+        self.parsed = 0
+        self.formats: collections.Counter = collections.Counter()
+        self.counters = {
+            key: collections.Counter()
+            for key in ("sections", "libraries", "imports", "rich")
+        }
+        self.entry = ColumnAccumulator(
+            STRUCTURE_ENTRY_BYTES, histogram=quorum < 1.0
+        )
 
-def common_prefix(chunks: Sequence[bytes]) -> bytes:
-    if not chunks:
-        return b""
-    limit = min(len(c) for c in chunks)
-    out = bytearray()
-    for i in range(limit):
-        b0 = chunks[0][i]
-        if all(chunk[i] == b0 for chunk in chunks[1:]):
-            out.append(b0)
+    def add(self, parsed: dict | None) -> None:
+        if parsed is None:
+            return
+        self.parsed += 1
+        self.formats[f"{parsed['format']} (machine 0x{parsed['machine']:X})"] += 1
+        for key, counter in self.counters.items():
+            # dict.fromkeys, not set: ties then keep a stable order across runs.
+            counter.update(dict.fromkeys(parsed[key]).keys())
+        if parsed["entry_bytes"]:
+            self.entry.add(parsed["entry_bytes"])
+
+    def result(self, threshold: int, args: argparse.Namespace) -> dict:
+        def common(key: str, limit: int) -> list[dict]:
+            items = [
+                {"value": value, "count": count}
+                for value, count in self.counters[key].most_common()
+                if count >= threshold
+            ]
+            return items[:limit]
+
+        if self.entry.count == 0:
+            values, agree, support = b"", b"", None
+        elif self.quorum < 1.0:
+            values, agree, support = self.entry.quorum_result(self.quorum)
         else:
-            break
-    return bytes(out)
+            values, agree = self.entry.result()
+            support = None
+        return {
+            "parsed_files": self.parsed,
+            "formats": top_items(self.formats, 10),
+            "common_sections": common("sections", 64),
+            "common_libraries": common("libraries", 64),
+            "common_imports": common("imports", args.top_strings),
+            "common_rich_entries": common("rich", 64),
+            "entry_point_files": self.entry.count,
+            "entry_point_runs": runs_from_columns(
+                values, agree, args.min_run, support=support
+            ),
+            "candidate_yara_entry_point_hex": (
+                yara_mask_from_columns(values, agree, STRUCTURE_ENTRY_BYTES)
+                if self.entry.count
+                else ""
+            ),
+        }
 
 
-def common_suffix(chunks: Sequence[bytes]) -> bytes:
-    if not chunks:
-        return b""
-    limit = min(len(c) for c in chunks)
-    out = bytearray()
-    for i in range(1, limit + 1):
-        b0 = chunks[0][-i]
-        if all(chunk[-i] == b0 for chunk in chunks[1:]):
-            out.append(b0)
+class EntropySummary:
+    """Aggregate ``entropy_profile`` results over the analyzed files.
+
+    Memory does not grow with the file count: mean entropies and each profile
+    bin go into fixed histograms of ``ENTROPY_HISTOGRAM_STEP`` bits, so the
+    reported medians are exact to half a step.
+    """
+
+    def __init__(self, high_entropy: float):
+        self.high_entropy = high_entropy
+        bins = round(8 / ENTROPY_HISTOGRAM_STEP) + 1
+        self.files = 0
+        self.mean_min = math.inf
+        self.mean_max = -math.inf
+        self.mean_counts = np.zeros(bins, dtype=np.int64)
+        self.profile_counts = np.zeros((ENTROPY_PROFILE_BINS, bins), dtype=np.int64)
+        self.high_counts = np.zeros(ENTROPY_PROFILE_BINS, dtype=np.int64)
+        self.partial = 0
+        self.with_regions = 0
+        self.largest: list[tuple[int, int, str]] = []
+
+    @staticmethod
+    def _bin(values) -> "np.ndarray":
+        return np.clip(
+            np.rint(np.asarray(values) / ENTROPY_HISTOGRAM_STEP).astype(np.int64),
+            0,
+            round(8 / ENTROPY_HISTOGRAM_STEP),
+        )
+
+    @staticmethod
+    def _median(counts: "np.ndarray") -> "np.ndarray":
+        """Median of histogram ``counts`` along the last axis, averaging the
+        two middle values for an even count like ``statistics.median``."""
+        total = counts.sum(axis=-1, keepdims=True)
+        cumulative = counts.cumsum(axis=-1)
+        low = (cumulative <= (total - 1) // 2).sum(axis=-1)
+        high = (cumulative <= total // 2).sum(axis=-1)
+        return (low + high) / 2 * ENTROPY_HISTOGRAM_STEP
+
+    def add(self, path: pathlib.Path, profile: dict | None) -> None:
+        if profile is None:
+            return
+        self.files += 1
+        mean = profile["mean"]
+        self.mean_min = min(self.mean_min, mean)
+        self.mean_max = max(self.mean_max, mean)
+        self.mean_counts[self._bin(mean)] += 1
+        values = np.asarray(profile["profile"])
+        self.profile_counts[np.arange(ENTROPY_PROFILE_BINS), self._bin(values)] += 1
+        self.high_counts += values >= self.high_entropy
+        self.partial += profile["partial"]
+        if profile["high_regions"]:
+            self.with_regions += 1
+        for offset, length in profile["high_regions"]:
+            item = (length, offset, str(path))
+            if len(self.largest) < ENTROPY_MAX_REGIONS:
+                heapq.heappush(self.largest, item)
+            else:
+                heapq.heappushpop(self.largest, item)
+
+    def result(self, args: argparse.Namespace) -> dict:
+        step = args.entropy_step if args.entropy_step > 0 else args.entropy_window
+        report = {
+            "mode": "numpy",
+            "window": args.entropy_window,
+            "step": step,
+            "high_entropy": args.high_entropy,
+            "files": self.files,
+            "partial_files": self.partial,
+            "files_with_high_entropy": self.with_regions,
+        }
+        if not self.files:
+            return report
+        high = self.high_counts / self.files
+        ranges = []
+        for i, fraction in enumerate(high.tolist()):
+            if fraction < args.string_presence:
+                continue
+            if ranges and ranges[-1]["to_bin"] == i:
+                ranges[-1]["to_bin"] = i + 1
+                ranges[-1]["min_fraction"] = min(ranges[-1]["min_fraction"], fraction)
+            else:
+                ranges.append({"from_bin": i, "to_bin": i + 1, "min_fraction": fraction})
+        report.update(
+            {
+                "mean_entropy": {
+                    "min": self.mean_min,
+                    "median": round(float(self._median(self.mean_counts)), 4),
+                    "max": self.mean_max,
+                },
+                "median_profile": np.round(self._median(self.profile_counts), 3).tolist(),
+                "high_entropy_fraction": np.round(high, 4).tolist(),
+                "common_high_entropy_ranges": [
+                    {
+                        "from": r["from_bin"] / ENTROPY_PROFILE_BINS,
+                        "to": r["to_bin"] / ENTROPY_PROFILE_BINS,
+                        "min_fraction": round(r["min_fraction"], 4),
+                    }
+                    for r in ranges
+                ],
+                "largest_high_entropy_regions": [
+                    {"file": name, "offset": offset, "length": length}
+                    for length, offset, name in sorted(self.largest, reverse=True)
+                ],
+            }
+        )
+        return report
+
+
+class JsonlReport:
+    """Stream per-file records to a JSONL file as they are analyzed, then the
+    summary report as the final line.
+
+    Records are ``{"type": "file", ...}``; ``extra`` (e.g. the cluster number)
+    is merged into each. The summary line is ``{"type": "summary", "report":
+    ...}``. Nothing per file is kept in memory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "w", encoding="utf-8")
+        self.extra: dict = {}
+        self.records = 0
+
+    def add(
+        self,
+        path: pathlib.Path | ArchiveMember,
+        features: dict,
+        duplicate_of: pathlib.Path | ArchiveMember | None = None,
+    ) -> None:
+        mime, desc = features["magic"]
+        record = {
+            "type": "file",
+            "path": str(path),
+            "size": features["size"],
+            "extension": file_extension(path),
+            "mime": mime or None,
+            "description": desc or None,
+            "header_hex": features["head"][:16].hex(),
+            "strings": len(features["strings"]),
+        }
+        if features.get("structure"):
+            record["format"] = features["structure"]["format"]
+        if features.get("entropy"):
+            record["entropy_mean"] = features["entropy"]["mean"]
+        if duplicate_of is not None:
+            record["duplicate_of"] = str(duplicate_of)
+        record.update(self.extra)
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.records += 1
+
+    def close(self, report: dict) -> None:
+        json.dump({"type": "summary", "report": report}, self.file, ensure_ascii=False)
+        self.file.write("\n")
+        self.file.close()
+
+
+class TraitAggregator:
+    """Running state behind the traits report.
+
+    ``add`` folds one sample's features into every accumulator in time
+    proportional to those features, and ``report`` builds the report from
+    the current state without consuming it, so samples can also be folded in
+    as they arrive (``--watch``). When ``expected_files`` is known up front,
+    string offsets are only tracked for strings that can still reach the
+    presence threshold; otherwise for every string the counter tracks.
+    """
+
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        expected_files: int | None = None,
+        records: JsonlReport | None = None,
+    ):
+        self.args = args
+        self.expected_files = expected_files
+        self.records = records
+        self.use_quorum = args.byte_quorum < 1.0
+        self.head_columns = ColumnAccumulator(
+            args.head_bytes, histogram=self.use_quorum
+        )
+        self.tail_columns = ColumnAccumulator(
+            args.tail_bytes, from_end=True, histogram=self.use_quorum
+        )
+        self.sizes = SizeStats()
+        if args.max_tracked_strings > 0:
+            self.string_counter = StringHeavyHitters(args.max_tracked_strings)
         else:
-            break
-    out.reverse()
-    return bytes(out)
+            self.string_counter = collections.Counter()
+        self.ext_counter: collections.Counter = collections.Counter()
+        self.mime_counter: collections.Counter = collections.Counter()
+        self.desc_counter: collections.Counter = collections.Counter()
+        self.structure = StructureSummary(args.byte_quorum) if args.structure else None
+        use_entropy = args.entropy and np is not None
+        self.entropy = EntropySummary(args.high_entropy) if use_entropy else None
+        use_ngrams = args.ngram_size > 0 and np is not None
+        self.ngram_df = (
+            HashDocumentFrequency(args.max_tracked_ngrams) if use_ngrams else None
+        )
+        # In --cluster mode cluster_samples() has already indexed every file.
+        self.index = (
+            SimilarityIndex(args.similarity_index)
+            if args.similarity_index and not args.cluster
+            else None
+        )
+        self.offset_stats = StringOffsetStats()
+        self.next_prune = 1024
+        self.pruned_undercount = 0
+        self.file_count = 0
+        # Every sample for the report's file list; with streamed records only
+        # the few that shared_byte_sequences() re-reads.
+        self.paths: list = []
 
+    def threshold(self) -> int:
+        files = self.expected_files or self.file_count
+        return max(1, math.ceil(files * self.args.string_presence))
 
-def stable_runs_at_fixed_offsets(chunks: Sequence[bytes], min_run: int) -> list[dict]:
-    if not chunks:
-        return []
-    limit = min(len(c) for c in chunks)
-    runs = []
-    current = bytearray()
-    start = None
+    def add(
+        self,
+        path: pathlib.Path | ArchiveMember,
+        features: dict,
+        copies: Sequence | None = None,
+    ) -> None:
+        """Fold in one sample, once per entry of ``copies`` (default: once)."""
+        args = self.args
+        if self.records is None or len(self.paths) < NGRAM_MAX_REPRESENTATIVES:
+            self.paths.append(path)
+        if self.index is not None:
+            self.index.add(path, features, args.lsh_bands)
+        string_counter = self.string_counter
+        # Copies are byte-identical: fold the same features once per copy.
+        for copy in copies or [path]:
+            self.file_count += 1
+            if self.records is not None:
+                self.records.add(
+                    copy, features, duplicate_of=path if copy != path else None
+                )
+            self.head_columns.add(features["head"])
+            self.tail_columns.add(features["tail"])
+            self.sizes.add(features["size"])
+            self.ext_counter[file_extension(copy)] += 1
+            mime, desc = features["magic"]
+            if mime:
+                self.mime_counter[mime] += 1
+            if desc:
+                self.desc_counter[desc] += 1
 
-    def flush():
-        nonlocal current, start, runs
-        if start is not None and len(current) >= min_run:
-            runs.append(
-                {
-                    "offset": start,
-                    "length": len(current),
-                    "hex": bytes(current).hex(" ").upper(),
-                    "ascii": printable_preview(bytes(current)),
-                }
+            string_counter.update(features["strings"].keys())
+            if self.structure is not None:
+                self.structure.add(features["structure"])
+            if self.entropy is not None:
+                self.entropy.add(copy, features["entropy"])
+            if isinstance(string_counter, StringHeavyHitters):
+                counts = string_counter.counts
+                undercount = string_counter.max_undercount
+            else:
+                counts = string_counter
+                undercount = 0
+            if self.expected_files is None:
+
+                def is_candidate(s: str) -> bool:
+                    return s in counts
+
+            else:
+                # A string is still a candidate while the counter tracks it and
+                # it can reach the presence threshold; only candidates get
+                # offset statistics.
+                slack = undercount + self.expected_files - self.file_count
+                threshold = self.threshold()
+
+                def is_candidate(s: str) -> bool:
+                    count = counts.get(s)
+                    return count is not None and count + slack >= threshold
+
+            self.offset_stats.update(
+                features["strings"], features["size"], is_candidate
             )
-        current = bytearray()
-        start = None
-
-    for i in range(limit):
-        values = {chunk[i] for chunk in chunks}
-        if len(values) == 1:
-            if start is None:
-                start = i
-            current.append(next(iter(values)))
-        else:
-            flush()
+            # Prune whenever the counter has evicted strings, so the offset
+            # table never outgrows the counter's bounded key set.
+            if (
+                undercount != self.pruned_undercount
+                or len(self.offset_stats.stats) > self.next_prune
+            ):
+                self.offset_stats.prune(is_candidate)
+                self.pruned_undercount = undercount
+                self.next_prune = max(1024, 2 * len(self.offset_stats.stats))
+            if self.ngram_df is not None:
+                self.ngram_df.update(features["ngrams"])
 
-    flush()
-    return runs
+    def close(self) -> None:
+        if self.index is not None:
+            self.index.close()
+            self.index = None
 
+    def report(self) -> dict:
+        """Build the traits report from the samples folded in so far."""
+        args = self.args
+        string_counter = self.string_counter
+        threshold = self.threshold()
+        if self.use_quorum:
+            quorum = args.byte_quorum
+            head_values, head_agree, head_support = self.head_columns.quorum_result(
+                quorum
+            )
+            tail_values, tail_agree, tail_support = self.tail_columns.quorum_result(
+                quorum
+            )
+        else:
+            head_values, head_agree = self.head_columns.result()
+            tail_values, tail_agree = self.tail_columns.result()
+            head_support = tail_support = None
+        header_prefix = leading_agreement(head_values, head_agree)
+        footer_suffix = leading_agreement(tail_values, tail_agree)[::-1]
 
-def stable_runs_from_end(chunks: Sequence[bytes], min_run: int) -> list[dict]:
-    if not chunks:
-        return []
-    limit = min(len(c) for c in chunks)
-    reversed_runs = []
-    current = bytearray()
-    start_from_end = None
-
-    def flush():
-        nonlocal current, start_from_end, reversed_runs
-        if start_from_end is not None and len(current) >= min_run:
-            data = bytes(reversed(current))
-            reversed_runs.append(
-                {
-                    "offset_from_end": start_from_end,
-                    "length": len(data),
-                    "hex": data.hex(" ").upper(),
-                    "ascii": printable_preview(data),
-                }
+        background = (
+            BackgroundIndex(args.background_index) if args.background_index else None
+        )
+        if isinstance(string_counter, StringHeavyHitters):
+            slack = string_counter.max_undercount
+            string_counting = {
+                "mode": "approximate",
+                "tracked_strings": len(string_counter.counts),
+                "total_occurrences": string_counter.total,
+                "max_undercount": slack,
+            }
+        else:
+            slack = 0
+            string_counting = {"mode": "exact"}
+        if self.ngram_df is not None:
+            shared_sequences = shared_byte_sequences(
+                self.paths, self.ngram_df.frequent(threshold), args, background
             )
-        current = bytearray()
-        start_from_end = None
-
-    for i in range(1, limit + 1):
-        values = {chunk[-i] for chunk in chunks}
-        if len(values) == 1:
-            if start_from_end is None:
-                start_from_end = i - 1
-            current.append(next(iter(values)))
+            ngram_counting = {
+                "mode": "approximate" if self.ngram_df.max_undercount else "exact",
+                "ngram_size": args.ngram_size,
+                "max_undercount": self.ngram_df.max_undercount,
+            }
         else:
-            flush()
+            shared_sequences = []
+            ngram_counting = {
+                "mode": "unavailable" if args.ngram_size > 0 else "off"
+            }
 
-    flush()
-    return reversed_runs
+        ranked_strings = sorted(
+            ((s, c) for s, c in string_counter.items() if c + slack >= threshold),
+            key=lambda item: (-item[1], -len(item[0]), item[0]),
+        )
+        if background is None:
+            common_strings = [
+                {"string": s, "count": c}
+                for s, c in ranked_strings[: args.top_strings]
+            ]
+        else:
+            common_strings = []
+            bg_counts = background.string_counts([s for s, _ in ranked_strings])
+            for (s, c), bg_count in zip(ranked_strings, bg_counts):
+                fraction = (
+                    bg_count / background.file_count if background.file_count else 0.0
+                )
+                if fraction > args.max_background_fraction:
+                    continue
+                common_strings.append(
+                    {
+                        "string": s,
+                        "count": c,
+                        "background_count": bg_count,
+                        "background_fraction": round(fraction, 4),
+                    }
+                )
+                if len(common_strings) >= args.top_strings:
+                    break
+            background.close()
+        for item in common_strings:
+            key = item["string"]
+            encoding, item["string"] = split_string_key(key)
+            if encoding:
+                item["encoding"] = encoding
+            # A decoded blob's text does not sit at the blob's offset.
+            if encoding not in ("base64", "hex"):
+                offsets = self.offset_stats.summary(
+                    key, item["count"], args.max_offset_range
+                )
+                if offsets is not None:
+                    item["offsets"] = offsets
 
+        report = {
+            "file_count": self.file_count,
+            "files": [str(p) for p in self.paths] if self.records is None else None,
+            "extensions": top_items(self.ext_counter, 20),
+            "size_stats": self.sizes.result(),
+            "common_header_prefix": {
+                "length": len(header_prefix),
+                "hex": header_prefix.hex(" ").upper(),
+                "ascii": printable_preview(header_prefix),
+            },
+            "common_footer_suffix": {
+                "length": len(footer_suffix),
+                "hex": footer_suffix.hex(" ").upper(),
+                "ascii": printable_preview(footer_suffix),
+            },
+            "stable_header_runs": runs_from_columns(
+                head_values, head_agree, args.min_run, support=head_support
+            ),
+            "stable_footer_runs": runs_from_columns(
+                tail_values,
+                tail_agree,
+                args.min_run,
+                from_end=True,
+                support=tail_support,
+            ),
+            "candidate_yara_header_hex": (
+                yara_mask_from_columns(head_values, head_agree, args.yara_window)
+                if self.head_columns.count
+                else ""
+            ),
+            "common_strings": common_strings,
+            "string_counting": string_counting,
+            "shared_byte_sequences": shared_sequences,
+            "structure": (
+                self.structure.result(threshold, args)
+                if self.structure is not None
+                else None
+            ),
+            "ngram_counting": ngram_counting,
+            "entropy": (
+                self.entropy.result(args)
+                if self.entropy is not None
+                else {"mode": "unavailable" if args.entropy else "off"}
+            ),
+            "background_index": (
+                {"path": args.background_index, "file_count": background.file_count}
+                if background is not None
+                else None
+            ),
+            "libmagic_mime_top": top_items(self.mime_counter, 10),
+            "libmagic_description_top": top_items(self.desc_counter, 10),
+            "notes": [
+                "Stable header runs are byte sequences that appear at the same offset in every analyzed file.",
+                "The candidate YARA header hex pattern is masked with ?? or [N] where bytes vary.",
+                "Common strings are counted once per file, not per occurrence.",
+                "String offsets describe the first occurrence in each file; an 'at' or 'in' condition is much cheaper for YARA than an unanchored string.",
+                "A strong YARA rule usually combines multiple traits: magic bytes, a few stable strings, and size/offset conditions.",
+            ],
+        }
+        return report
 
-def yara_mask_from_heads(chunks: Sequence[bytes], window: int) -> str:
-    if not chunks:
-        return ""
-    limit = min(window, min(len(c) for c in chunks))
-    tokens: list[str] = []
-    wildcard_run = 0
 
-    def flush_wildcards():
-        nonlocal wildcard_run, tokens
-        if wildcard_run == 0:
-            return
-        if wildcard_run <= 2:
-            tokens.extend(["??"] * wildcard_run)
-        else:
-            tokens.append(f"[{wildcard_run}]")
-        wildcard_run = 0
+def build_report(
+    paths: Sequence[pathlib.Path],
+    args: argparse.Namespace,
+    copies: dict | None = None,
+    records: JsonlReport | None = None,
+) -> dict:
+    """Aggregate the features of ``paths`` into the traits report.
 
-    for i in range(limit):
-        values = {chunk[i] for chunk in chunks}
-        if len(values) == 1:
-            flush_wildcards()
-            tokens.append(f"{next(iter(values)):02X}")
+    With ``copies`` (sample -> all its byte-identical copies, from
+    ``find_duplicates``) each sample is extracted once but counted once per
+    copy, as if every copy had been analyzed. With ``records`` every file is
+    written out as it is folded in, and the report carries no file list.
+    """
+    copy_lists = [copies.get(path, [path]) if copies else [path] for path in paths]
+    aggregator = TraitAggregator(
+        args, sum(len(copy_list) for copy_list in copy_lists), records
+    )
+    features_iter = iter_features(paths, args)
+    try:
+        for path, copy_list in zip(paths, copy_lists):
+            with stats_phase("extract", files=1):
+                features = next(features_iter)
+            with stats_phase("aggregate", files=1):
+                aggregator.add(path, features, copy_list)
+    finally:
+        features_iter.close()
+        aggregator.close()
+    with stats_phase("report"):
+        return aggregator.report()
+
+
+class AhoCorasick:
+    """Minimal Aho-Corasick automaton that reports which patterns occur.
+
+    ``scan`` keeps its state across chunks, so a file can be fed in pieces
+    and matches spanning a chunk edge are still found.
+    """
+
+    def __init__(self, patterns: Sequence[bytes]):
+        self.goto: list[dict[int, int]] = [{}]
+        self.fail = [0]
+        self.out: list[set[int]] = [set()]
+        for index, pattern in enumerate(patterns):
+            state = 0
+            for b in pattern:
+                nxt = self.goto[state].get(b)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][b] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(set())
+                state = nxt
+            self.out[state].add(index)
+
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for b, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and b not in self.goto[f]:
+                    f = self.fail[f]
+                fallback = self.goto[f].get(b, 0)
+                self.fail[nxt] = fallback if fallback != nxt else 0
+                self.out[nxt] |= self.out[self.fail[nxt]]
+        self.pattern_count = len(patterns)
+
+    def scan(self, chunks: Iterable[bytes]) -> set[int]:
+        goto, fail, out = self.goto, self.fail, self.out
+        found: set[int] = set()
+        state = 0
+        for chunk in chunks:
+            for b in chunk:
+                while state and b not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(b, 0)
+                if out[state]:
+                    found |= out[state]
+            if len(found) == self.pattern_count:
+                break
+        return found
+
+
+def parse_yara_hex(pattern: str) -> list[int | None]:
+    """Turn ``{ 4D 5A ?? [3] 00 }`` into bytes, with None for wildcards."""
+    out: list[int | None] = []
+    for token in pattern.strip("{} ").split():
+        if token == "??":
+            out.append(None)
+        elif token.startswith("["):
+            out.extend([None] * int(token.strip("[]")))
         else:
-            wildcard_run += 1
+            out.append(int(token, 16))
+    return out
 
-    flush_wildcards()
-    return "{ " + " ".join(tokens) + " }"
 
+def validation_traits(report: dict) -> list[dict]:
+    """Collect the report's header pattern, stable runs and common strings as
+    individually checkable traits."""
+    traits = []
+    mask = parse_yara_hex(report["candidate_yara_header_hex"] or "{ }")
+    while mask and mask[-1] is None:
+        mask.pop()
+    lead = 0
+    while lead < len(mask) and mask[lead] is None:
+        lead += 1
+    if lead < len(mask):
+        traits.append(
+            {
+                "kind": "at",
+                "label": f"header pattern at {lead}",
+                "offset": lead,
+                "mask": mask[lead:],
+            }
+        )
+    for run in report["stable_header_runs"]:
+        traits.append(
+            {
+                "kind": "at",
+                "label": f"header run at 0x{run['offset']:X}",
+                "offset": run["offset"],
+                "mask": list(bytes.fromhex(run["hex"])),
+            }
+        )
+    for run in report["stable_footer_runs"]:
+        traits.append(
+            {
+                "kind": "at_end",
+                "label": f"footer run at end-0x{run['offset_from_end']:X}",
+                "offset": run["offset_from_end"],
+                "mask": list(bytes.fromhex(run["hex"])),
+            }
+        )
+    for item in report["common_strings"]:
+        traits.append(
+            {
+                "kind": "string",
+                "label": f"{item.get('encoding', '')} string {item['string']!r}".lstrip(),
+                "value": item["string"],
+                "encoding": item.get("encoding", ""),
+            }
+        )
+    return traits
 
-def printable_preview(data: bytes, max_len: int = 64) -> str:
-    out = []
-    for b in data[:max_len]:
-        if 32 <= b <= 126:
-            out.append(chr(b))
+
+YARA_STRING_MODIFIERS = {
+    "": "ascii wide",
+    "xor": "xor(0x20-0xff)",
+    "base64": "base64",
+}
+
+
+def encoded_string_patterns(text: str, encoding: str) -> list[bytes]:
+    """Every byte sequence that ``text`` found in ``encoding`` form can take:
+    each XOR key, each base64 alignment (minus the edge characters that
+    depend on neighbouring bytes), both hex letter cases."""
+    data = text.encode("ascii", errors="ignore")
+    if encoding == "utf16be":
+        return [text.encode("utf-16-be")]
+    if encoding == "xor":
+        return [bytes(c ^ key for c in data) for key in range(0x20, 0x100)]
+    if encoding == "base64":
+        patterns = []
+        for shift in range(3):
+            encoded = base64.b64encode(b"\x00" * shift + data)
+            patterns.append(encoded[(8 * shift + 5) // 6 : (shift + len(data)) * 8 // 6])
+        return patterns
+    if encoding == "hex":
+        return [data.hex().encode(), data.hex().upper().encode()]
+    return [text.encode("ascii"), text.encode("utf-16le")]
+
+
+def _hex_token(value: int | None) -> str:
+    return "??" if value is None else f"{value:02X}"
+
+
+def yara_source_for_traits(traits: Sequence[dict]) -> str:
+    """One YARA rule per trait, so a single scan reports every matching trait."""
+    rules = []
+    for i, trait in enumerate(traits):
+        if trait["kind"] == "string":
+            if trait["encoding"] == "utf16be":
+                string = "{ " + trait["value"].encode("utf-16-be").hex(" ") + " }"
+            elif trait["encoding"] == "hex":
+                string = f'"{trait["value"].encode("ascii").hex()}" nocase'
+            else:
+                escaped = trait["value"].replace("\\", "\\\\").replace('"', '\\"')
+                modifiers = YARA_STRING_MODIFIERS[trait["encoding"]]
+                string = f'"{escaped}" {modifiers}'
+            condition = "$t"
         else:
-            out.append(".")
-    s = "".join(out)
-    if len(data) > max_len:
-        s += "..."
-    return s
+            string = "{ " + " ".join(_hex_token(v) for v in trait["mask"]) + " }"
+            if trait["kind"] == "at":
+                condition = f"$t at {trait['offset']}"
+            else:
+                back = trait["offset"] + len(trait["mask"])
+                condition = f"filesize >= {back} and $t at filesize - {back}"
+        rules.append(f"rule t{i} {{ strings: $t = {string} condition: {condition} }}")
+    return "\n".join(rules)
 
 
-def top_items(counter: collections.Counter, top_n: int) -> list[dict]:
-    items = []
-    for value, count in counter.most_common(top_n):
-        items.append({"value": value, "count": count})
-    return items
+_TRAIT_MATCHER: dict = {}
 
 
-def try_magic_descriptions(paths: Sequence[pathlib.Path]) -> collections.Counter:
-    counter: collections.Counter = collections.Counter()
+def _init_trait_matcher(traits: Sequence[dict], byte_budget: int) -> None:
+    """Prepare the per-process matcher: yara-python if available, else an
+    Aho-Corasick automaton over the string traits plus direct offset checks."""
+    _TRAIT_MATCHER.clear()
+    _TRAIT_MATCHER["traits"] = traits
+    _TRAIT_MATCHER["byte_budget"] = byte_budget
     try:
-        import magic  # type: ignore
-    except Exception:
-        return counter
+        import yara  # type: ignore
 
-    try:
-        magic_desc = magic.Magic(mime=False)
+        _TRAIT_MATCHER["yara"] = yara.compile(source=yara_source_for_traits(traits))
+        return
     except Exception:
-        return counter
+        pass
 
-    for path in paths:
-        try:
-            desc = magic_desc.from_file(str(path))
-            if desc:
-                counter[desc] += 1
-        except Exception:
-            pass
-    return counter
+    patterns = []
+    owners = []
+    for i, trait in enumerate(traits):
+        if trait["kind"] == "string":
+            for pattern in encoded_string_patterns(trait["value"], trait["encoding"]):
+                patterns.append(pattern)
+                owners.append(i)
+    _TRAIT_MATCHER["automaton"] = AhoCorasick(patterns)
+    _TRAIT_MATCHER["owners"] = owners
+    _TRAIT_MATCHER["head_bytes"] = max(
+        (t["offset"] + len(t["mask"]) for t in traits if t["kind"] == "at"), default=0
+    )
+    _TRAIT_MATCHER["tail_bytes"] = max(
+        (t["offset"] + len(t["mask"]) for t in traits if t["kind"] == "at_end"),
+        default=0,
+    )
 
 
-def try_magic_mime(paths: Sequence[pathlib.Path]) -> collections.Counter:
-    counter: collections.Counter = collections.Counter()
-    try:
-        import magic  # type: ignore
-    except Exception:
-        return counter
+def trait_matcher_engine() -> str:
+    return "yara-python" if "yara" in _TRAIT_MATCHER else "aho-corasick"
+
+
+def _masked_equal(data: bytes, mask: Sequence[int | None]) -> bool:
+    return len(data) == len(mask) and all(
+        m is None or m == b for m, b in zip(mask, data)
+    )
+
+
+def _read_chunks(f, byte_budget: int, chunk_bytes: int = 1024 * 1024) -> Iterator[bytes]:
+    remaining = byte_budget if byte_budget > 0 else None
+    while remaining is None or remaining > 0:
+        chunk = f.read(chunk_bytes if remaining is None else min(chunk_bytes, remaining))
+        if not chunk:
+            return
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+
 
+def match_traits(path: pathlib.Path) -> frozenset[int]:
+    """Return the indices of the traits that match ``path``."""
     try:
-        magic_mime = magic.Magic(mime=True)
-    except Exception:
-        return counter
+        if "yara" in _TRAIT_MATCHER:
+            if isinstance(path, ArchiveMember):
+                with path.open("rb") as f:
+                    matches = _TRAIT_MATCHER["yara"].match(data=f.read())
+            else:
+                matches = _TRAIT_MATCHER["yara"].match(str(path))
+            return frozenset(int(m.rule[1:]) for m in matches)
 
-    for path in paths:
-        try:
-            mime = magic_mime.from_file(str(path))
-            if mime:
-                counter[mime] += 1
-        except Exception:
-            pass
-    return counter
+        traits = _TRAIT_MATCHER["traits"]
+        head, tail, size = safe_read_head_tail(
+            path, _TRAIT_MATCHER["head_bytes"], _TRAIT_MATCHER["tail_bytes"]
+        )
+        found = set()
+        for i, trait in enumerate(traits):
+            if trait["kind"] == "at":
+                start = trait["offset"]
+                if _masked_equal(head[start : start + len(trait["mask"])], trait["mask"]):
+                    found.add(i)
+            elif trait["kind"] == "at_end":
+                back = trait["offset"] + len(trait["mask"])
+                if size >= back and _masked_equal(
+                    tail[len(tail) - back : len(tail) - trait["offset"]], trait["mask"]
+                ):
+                    found.add(i)
 
+        automaton = _TRAIT_MATCHER["automaton"]
+        if automaton.pattern_count:
+            with path.open("rb") as f:
+                chunks = _read_chunks(f, _TRAIT_MATCHER["byte_budget"])
+                for index in automaton.scan(chunks):
+                    found.add(_TRAIT_MATCHER["owners"][index])
+        return frozenset(found)
+    except OSError:
+        return frozenset()
 
-def build_report(paths: Sequence[pathlib.Path], args: argparse.Namespace) -> dict:
-    heads: list[bytes] = []
-    tails: list[bytes] = []
-    sizes: list[int] = []
-    string_counter: collections.Counter = collections.Counter()
-    ext_counter: collections.Counter = collections.Counter()
 
-    for path in paths:
-        head, tail, size = safe_read_head_tail(path, args.head_bytes, args.tail_bytes)
-        heads.append(head)
-        tails.append(tail)
-        sizes.append(size)
-        ext_counter[path.suffix.lower() or "<no extension>"] += 1
+def trait_presence(
+    traits: Sequence[dict], paths: Sequence[pathlib.Path], args: argparse.Namespace
+) -> tuple[list[int], str]:
+    """Scan every file once for all traits; return one presence bitset per
+    trait (bit ``j`` set when ``paths[j]`` matches) and the engine used."""
+    bitmaps = [bytearray((len(paths) + 7) // 8) for _ in traits]
+    init_args = (traits, args.string_byte_budget)
 
-        strings = extract_strings(path, args.min_string_len)
-        for s in strings:
-            string_counter[s] += 1
-
-    num_files = len(paths)
-    threshold = max(1, math.ceil(num_files * args.string_presence))
-    common_strings = [
-        {"string": s, "count": c}
-        for s, c in sorted(
-            ((s, c) for s, c in string_counter.items() if c >= threshold),
-            key=lambda item: (-item[1], -len(item[0]), item[0]),
-        )[: args.top_strings]
-    ]
+    _init_trait_matcher(*init_args)
+    engine = trait_matcher_engine()
+    results = pool_map(
+        match_traits, paths, args, initializer=_init_trait_matcher, initargs=init_args
+    )
+    for j, matched in enumerate(results):
+        for i in matched:
+            bitmaps[i][j >> 3] |= 1 << (j & 7)
+    return [int.from_bytes(bitmap, "little") for bitmap in bitmaps], engine
 
-    report = {
-        "file_count": num_files,
-        "files": [str(p) for p in paths],
-        "extensions": top_items(ext_counter, 20),
-        "size_stats": {
-            "min": min(sizes) if sizes else 0,
-            "max": max(sizes) if sizes else 0,
-            "mean": round(statistics.mean(sizes), 2) if sizes else 0,
-            "median": int(statistics.median(sizes)) if sizes else 0,
-        },
-        "common_header_prefix": {
-            "length": len(common_prefix(heads)),
-            "hex": common_prefix(heads).hex(" ").upper(),
-            "ascii": printable_preview(common_prefix(heads)),
-        },
-        "common_footer_suffix": {
-            "length": len(common_suffix(tails)),
-            "hex": common_suffix(tails).hex(" ").upper(),
-            "ascii": printable_preview(common_suffix(tails)),
-        },
-        "stable_header_runs": stable_runs_at_fixed_offsets(heads, args.min_run),
-        "stable_footer_runs": stable_runs_from_end(tails, args.min_run),
-        "candidate_yara_header_hex": yara_mask_from_heads(heads, args.yara_window),
-        "common_strings": common_strings,
-        "libmagic_mime_top": top_items(try_magic_mime(paths), 10),
-        "libmagic_description_top": top_items(try_magic_descriptions(paths), 10),
-        "notes": [
-            "Stable header runs are byte sequences that appear at the same offset in every analyzed file.",
-            "The candidate YARA header hex pattern is masked with ?? or [N] where bytes vary.",
-            "Common strings are counted once per file, not per occurrence.",
-            "A strong YARA rule usually combines multiple traits: magic bytes, a few stable strings, and size/offset conditions.",
+
+def select_traits(
+    traits: Sequence[dict],
+    pos_bits: Sequence[int],
+    neg_bits: Sequence[int],
+    pos_count: int,
+    neg_count: int,
+    args: argparse.Namespace,
+) -> dict:
+    """Greedily pick a small trait set so each positive matches ``--cover-depth``
+    of them, i.e. a rule condition of "N of them".
+
+    Traits above ``--max-trait-fp`` on the negative set are skipped. Coverage
+    is tracked as bitsets per depth (``levels[k]`` = positives hit at least
+    ``k`` times), and since a trait's gain can only shrink as coverage grows,
+    gains are re-evaluated lazily from a heap.
+    """
+    depth = max(1, args.cover_depth)
+    everyone = (1 << pos_count) - 1
+    levels = [everyone] + [0] * depth
+    neg_levels = [(1 << neg_count) - 1] + [0] * depth
+
+    def gain(i: int) -> int:
+        return (pos_bits[i] & ~levels[depth]).bit_count()
+
+    heap = []
+    for i in range(len(traits)):
+        fp_rate = neg_bits[i].bit_count() / neg_count if neg_count else 0.0
+        if fp_rate <= args.max_trait_fp and pos_bits[i]:
+            heap.append((-gain(i), neg_bits[i].bit_count(), i))
+    heapq.heapify(heap)
+
+    chosen = []
+    while heap and levels[depth] != everyone:
+        _, fp, i = heapq.heappop(heap)
+        current = gain(i)
+        if not current:
+            continue
+        if heap and current < -heap[0][0]:
+            heapq.heappush(heap, (-current, fp, i))
+            continue
+        chosen.append(i)
+        for k in range(depth, 0, -1):
+            levels[k] |= levels[k - 1] & pos_bits[i]
+            neg_levels[k] |= neg_levels[k - 1] & neg_bits[i]
+
+    return {
+        "condition": f"{depth} of them" if chosen else "",
+        "cover_depth": depth,
+        "traits": [
+            {
+                "trait": traits[i]["label"],
+                "tp": pos_bits[i].bit_count(),
+                "fp": neg_bits[i].bit_count(),
+            }
+            for i in chosen
         ],
+        "positive_coverage": round(levels[depth].bit_count() / max(pos_count, 1), 4),
+        "negative_hits": neg_levels[depth].bit_count(),
+        "negative_count": neg_count,
     }
-    return report
+
+
+def check_traits(
+    report: dict,
+    positives: Sequence[pathlib.Path],
+    negatives: Sequence[pathlib.Path] | None,
+    args: argparse.Namespace,
+) -> None:
+    """Scan positive (and negative) files once for every candidate trait and
+    fill in ``report["validation"]`` and/or ``report["trait_selection"]``."""
+    traits = validation_traits(report)
+    negatives = list(negatives or [])
+    presence, engine = trait_presence(traits, list(positives) + negatives, args)
+    pos_count = len(positives)
+    pos_mask = (1 << pos_count) - 1
+    pos_bits = [bits & pos_mask for bits in presence]
+    neg_bits = [bits >> pos_count for bits in presence]
+
+    if args.validate_against:
+        pos_total = max(pos_count, 1)
+        neg_total = max(len(negatives), 1)
+        report["validation"] = {
+            "negative_directory": args.validate_against,
+            "positive_count": pos_count,
+            "negative_count": len(negatives),
+            "engine": engine,
+            "traits": [
+                {
+                    "trait": trait["label"],
+                    "tp": pos_bits[i].bit_count(),
+                    "tp_rate": round(pos_bits[i].bit_count() / pos_total, 4),
+                    "fp": neg_bits[i].bit_count(),
+                    "fp_rate": round(neg_bits[i].bit_count() / neg_total, 4),
+                }
+                for i, trait in enumerate(traits)
+            ],
+        }
+    if args.select_traits:
+        report["trait_selection"] = select_traits(
+            traits, pos_bits, neg_bits, pos_count, len(negatives), args
+        )
+
+
+def run_support_suffix(run: dict) -> str:
+    if "min_support" not in run:
+        return ""
+    return f"    support: {run['min_support']:.0%}+"
+
+
+def background_suffix(item: dict) -> str:
+    if "background_count" not in item:
+        return ""
+    return f" [goodware {item['background_fraction']:.1%}]"
+
+
+def presence_suffix(item: dict) -> str:
+    presence = item.get("presence")
+    if not presence:
+        return ""
+    return (
+        f" [{SAMPLE_CONFIDENCE:.0%} CI {presence['low']:.1%}-{presence['high']:.1%}]"
+    )
+
+
+def offset_suffix(item: dict) -> str:
+    offsets = item.get("offsets")
+    if not offsets or not offsets["condition"]:
+        return ""
+    return f" [{offsets['condition']}]"
 
 
 def print_report(report: dict, args: argparse.Namespace) -> None:
     print("=" * 80)
     print("Common traits report for YARA drafting")
     print("=" * 80)
-    print(f"Files analyzed       : {report['file_count']}")
+    sampling = report.get("sampling")
+    if sampling:
+        print(
+            f"Files analyzed       : {report['file_count']} "
+            f"(uniform sample of {sampling['population']}, seed {sampling['seed']})"
+        )
+    else:
+        print(f"Files analyzed       : {report['file_count']}")
     print(
         f"Size min/median/max  : {report['size_stats']['min']} / {report['size_stats']['median']} / {report['size_stats']['max']}"
     )
@@ -447,6 +4350,7 @@ def print_report(report: dict, args: argparse.Namespace) -> None:
         for run in report["stable_header_runs"]:
             print(
                 f"  - offset 0x{run['offset']:X} ({run['offset']}), len {run['length']}: {run['hex']}    ASCII: {run['ascii']}"
+                f"{run_support_suffix(run)}"
             )
     else:
         print("  <none found>")
@@ -457,7 +4361,7 @@ def print_report(report: dict, args: argparse.Namespace) -> None:
         for run in report["stable_footer_runs"]:
             print(
                 f"  - from end -0x{run['offset_from_end']:X} (-{run['offset_from_end']}), len {run['length']}: "
-                f"{run['hex']}    ASCII: {run['ascii']}"
+                f"{run['hex']}    ASCII: {run['ascii']}{run_support_suffix(run)}"
             )
     else:
         print("  <none found>")
@@ -469,16 +4373,119 @@ def print_report(report: dict, args: argparse.Namespace) -> None:
 
     presence_pct = int(args.string_presence * 100)
     print(f"Common strings (present in at least {presence_pct}% of files):")
+    counting = report["string_counting"]
+    if counting["mode"] == "approximate":
+        print(
+            f"  (approximate: counts are lower bounds, low by at most "
+            f"{counting['max_undercount']} files)"
+        )
     if report["common_strings"]:
         for item in report["common_strings"]:
             s = item["string"]
+            if "encoding" in item:
+                s = f"({item['encoding']}) {s}"
             if len(s) > 120:
                 s = s[:117] + "..."
-            print(f"  - [{item['count']} files] {s}")
+            print(
+                f"  - [{item['count']} files]{presence_suffix(item)}"
+                f"{background_suffix(item)}{offset_suffix(item)} {s}"
+            )
     else:
         print("  <none found>")
     print()
 
+    structure = report.get("structure")
+    if structure is not None:
+        print(f"Executable structure ({structure['parsed_files']} parsed files):")
+        for item in structure["formats"]:
+            print(f"  - {item['value']}: {item['count']}")
+        for key, title in (
+            ("common_sections", "Sections"),
+            ("common_libraries", "Libraries"),
+            ("common_imports", "Imports"),
+            ("common_rich_entries", "Rich header tool ids (prod_id.build)"),
+        ):
+            if structure[key]:
+                print(f"  {title}:")
+                for item in structure[key]:
+                    print(f"    - [{item['count']} files] {item['value']}")
+        print(
+            f"  Entry point bytes ({structure['entry_point_files']} files): "
+            f"{structure['candidate_yara_entry_point_hex'] or '<none>'}"
+        )
+        for run in structure["entry_point_runs"]:
+            print(
+                f"    - entry+0x{run['offset']:X}, len {run['length']}: {run['hex']}"
+                f"{run_support_suffix(run)}"
+            )
+        print()
+
+    entropy = report["entropy"]
+    if entropy["mode"] == "unavailable":
+        print("Entropy profile: unavailable (needs NumPy).")
+        print()
+    elif entropy["mode"] != "off":
+        print(
+            f"Entropy profile (window {entropy['window']}, step {entropy['step']}, "
+            f"{entropy['files']} files):"
+        )
+        if "mean_entropy" in entropy:
+            mean = entropy["mean_entropy"]
+            print(
+                f"  Mean entropy min/median/max : "
+                f"{mean['min']:.2f} / {mean['median']:.2f} / {mean['max']:.2f}"
+            )
+            # One digit per normalized-offset bin: integer bits per byte.
+            digits = "".join(str(min(int(v), 7)) for v in entropy["median_profile"])
+            print(f"  Median profile (start->end) : {digits}")
+            print(
+                f"  Files with windows >= {entropy['high_entropy']} bits: "
+                f"{entropy['files_with_high_entropy']}"
+            )
+            for r in entropy["common_high_entropy_ranges"]:
+                print(
+                    f"  - high entropy at {r['from']:.0%}-{r['to']:.0%} of the file "
+                    f"in {r['min_fraction']:.0%}+ of files"
+                )
+            for r in entropy["largest_high_entropy_regions"]:
+                print(
+                    f"  - 0x{r['offset']:X} +0x{r['length']:X} in {r['file']}"
+                )
+        if entropy["partial_files"]:
+            print(
+                f"  ({entropy['partial_files']} files hit --entropy-time-budget "
+                "and were sampled)"
+            )
+        print()
+
+    ngram_counting = report["ngram_counting"]
+    if ngram_counting["mode"] == "unavailable":
+        print("Shared byte sequences at any offset:")
+        print("  NumPy not installed, n-gram analysis unavailable.")
+        print()
+    elif ngram_counting["mode"] != "off":
+        print(
+            f"Shared byte sequences at any offset ({ngram_counting['ngram_size']}-gram "
+            f"document frequency, present in at least {presence_pct}% of files):"
+        )
+        if ngram_counting["max_undercount"]:
+            print(
+                f"  (approximate: counts are lower bounds, low by at most "
+                f"{ngram_counting['max_undercount']} files)"
+            )
+        if report["shared_byte_sequences"]:
+            for item in report["shared_byte_sequences"]:
+                print(
+                    f"  - [{item['files']} of {item['checked_files']} checked files]"
+                    f"{background_suffix(item)} "
+                    f"len {item['length']} "
+                    f"(e.g. offset 0x{item['example_offset']:X}): {item['hex']}"
+                )
+                print(f"      ASCII: {item['ascii']}")
+        else:
+            print("  <none found>")
+        print()
+
     if report["libmagic_mime_top"] or report["libmagic_description_top"]:
         print("libmagic guesses:")
         for item in report["libmagic_mime_top"]:
@@ -491,6 +4498,42 @@ def print_report(report: dict, args: argparse.Namespace) -> None:
         print("  python-magic not installed, or file type detection unavailable.")
         print()
 
+    validation = report.get("validation")
+    if validation:
+        print(
+            f"Trait validation ({validation['engine']}): {validation['positive_count']} "
+            f"positive, {validation['negative_count']} negative files"
+        )
+        if validation["traits"]:
+            for item in validation["traits"]:
+                label = item["trait"]
+                if len(label) > 60:
+                    label = label[:57] + "..."
+                print(
+                    f"  - TP {item['tp_rate']:6.1%}  FP {item['fp_rate']:6.1%}  {label}"
+                )
+        else:
+            print("  <no traits to validate>")
+        print()
+
+    selection = report.get("trait_selection")
+    if selection:
+        print(f"Proposed trait set (each sample matches {selection['cover_depth']}+):")
+        if selection["traits"]:
+            for item in selection["traits"]:
+                label = item["trait"]
+                if len(label) > 60:
+                    label = label[:57] + "..."
+                print(f"  - [{item['tp']} TP / {item['fp']} FP] {label}")
+            print(
+                f"  condition: {selection['condition']}  -> covers "
+                f"{selection['positive_coverage']:.1%} of samples, "
+                f"{selection['negative_hits']}/{selection['negative_count']} negatives"
+            )
+        else:
+            print("  <no usable traits>")
+        print()
+
     print("How to use this for YARA:")
     print(
         "  1. Prefer the stable header runs and common strings with high specificity."
@@ -501,15 +4544,214 @@ def print_report(report: dict, args: argparse.Namespace) -> None:
     print()
 
 
+def write_json_atomic(path: str, data: dict) -> None:
+    """Write JSON through a temporary file, so readers never see half a report."""
+    partial = f"{path}.partial"
+    with open(partial, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(partial, path)
+
+
+def watch_directory(root: pathlib.Path, args: argparse.Namespace) -> int:
+    """``--watch``: fold new samples into a running TraitAggregator as they
+    arrive and re-emit the report after a debounce.
+
+    The directory is rescanned every ``--watch-poll`` seconds. A new file is
+    taken once its size and mtime held still over one scan, so files that are
+    still being written are not read half-way. Files already folded in are
+    not revisited, even if they change. Each fold costs one feature
+    extraction; re-emitting the report costs nothing per past sample.
+    """
+    records = JsonlReport(args.jsonl_out) if args.jsonl_out else None
+    aggregator = TraitAggregator(args, records=records)
+    seen: set[str] = set()
+    settling: dict[str, tuple[int, int]] = {}
+    pending_since = last_fold = None
+
+    def emit(final: bool = False) -> dict:
+        report = aggregator.report()
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        print(f"##### {stamp}: {aggregator.file_count} files{' (final)' if final else ''}")
+        print_report(report, args)
+        if final and _RUN_STATS is not None:
+            report["stats"] = _RUN_STATS.result()
+            print_stats(report["stats"])
+        if args.json_out:
+            write_json_atomic(args.json_out, report)
+        return report
+
+    print(f"[+] Watching {root} (Ctrl-C to stop)")
+    try:
+        while True:
+            ready = []
+            # Keep the walk stats to this scan, so deleted files do not linger.
+            _WALK_STATS.clear()
+            for path in sorted(iter_files(str(root), args.recursive)):
+                key = str(path)
+                if key in seen:
+                    continue
+                st = sample_stat(path)
+                state = (st.st_size, st.st_mtime_ns)
+                if settling.get(key) == state:
+                    del settling[key]
+                    seen.add(key)
+                    ready.append(path)
+                else:
+                    settling[key] = state
+            if args.archives and ready:
+                ready = expand_archives(ready, args)
+            if ready:
+                for path, features in zip(ready, iter_features(ready, args)):
+                    aggregator.add(path, features)
+                last_fold = time.monotonic()
+                pending_since = pending_since or last_fold
+
+            now = time.monotonic()
+            if pending_since is not None and (
+                now - last_fold >= args.watch_debounce
+                or now - pending_since >= WATCH_MAX_DEBOUNCES * args.watch_debounce
+            ):
+                emit()
+                pending_since = None
+            time.sleep(args.watch_poll)
+    except KeyboardInterrupt:
+        print()
+    finally:
+        aggregator.close()
+
+    if aggregator.file_count == 0:
+        print("[!] No files arrived.")
+        if records is not None:
+            records.close(aggregator.report())
+        return 1
+    report = emit(final=True)
+    if records is not None:
+        records.close(report)
+        print(f"[+] Wrote {records.records} file records and the summary to: {records.path}")
+    if args.json_out:
+        print(f"[+] Wrote JSON report to: {args.json_out}")
+    return 0
+
+
+def run_similarity_query(root: pathlib.Path, args: argparse.Namespace) -> int:
+    if root.is_file():
+        paths = [root]
+    elif root.is_dir():
+        paths = sorted(iter_files(str(root), args.recursive))
+    else:
+        print(f"[!] Not a file or directory: {root}")
+        return 2
+    if args.archives:
+        paths = expand_archives(paths, args)
+    if args.max_files > 0:
+        paths = paths[: args.max_files]
+    if not pathlib.Path(args.query_index).is_file():
+        print(f"[!] No such index: {args.query_index}")
+        return 2
+
+    index = SimilarityIndex(args.query_index)
+    params = index.params()
+    index.close()
+    if params is None:
+        print(f"[!] {args.query_index} is empty.")
+        return 1
+    # Signatures must be computed exactly the way the index was built.
+    for key, value in params.items():
+        setattr(args, key, value)
+
+    results = query_similarity_index(paths, args)
+    for item in results:
+        print(f"{item['query']}:")
+        if not item["matches"]:
+            print("  <no similar samples found>")
+        for match in item["matches"]:
+            print(
+                f"  - {match['similarity']:6.1%}  header {match['common_header_bytes']:>2}B  "
+                f"{match['path']}"
+            )
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"[+] Wrote JSON results to: {args.json_out}")
+    return 0
+
+
 def main() -> int:
+    global _RUN_STATS
     args = parse_args()
+    if args.stats or args.profile_phase:
+        args.stats = True
+        _RUN_STATS = RunStats(args.profile_phase, args.profile_out)
 
     root = pathlib.Path(args.directory)
+    if args.query_index:
+        return run_similarity_query(root, args)
     if not root.exists() or not root.is_dir():
         print(f"[!] Not a directory: {root}")
         return 2
+    if args.similarity_index:
+        index = SimilarityIndex(args.similarity_index)
+        existing = index.params()
+        if existing is None:
+            index.set_params(similarity_params(args))
+        index.close()
+        if existing is not None and existing != similarity_params(args):
+            print(
+                f"[!] {args.similarity_index} was built with different options: "
+                f"{json.dumps(existing)}"
+            )
+            return 2
+
+    if args.watch:
+        unsupported = [
+            flag
+            for flag, used in (
+                ("--cluster", args.cluster),
+                ("--dedup", args.dedup != "off"),
+                ("--validate-against", args.validate_against),
+                ("--select-traits", args.select_traits),
+                ("--build-background-index", args.build_background_index),
+                ("--sample", args.sample > 0),
+            )
+            if used
+        ]
+        if unsupported:
+            print(f"[!] --watch cannot be combined with {', '.join(unsupported)}")
+            return 2
+        return watch_directory(root, args)
 
-    paths = sorted(iter_files(str(root), args.recursive))
+    sampling = None
+    if args.sample > 0:
+        if args.archives:
+            # The population would count archives while the sample holds members.
+            print("[!] --sample cannot be combined with --archives")
+            return 2
+        # --max-files shrinks the draw itself, so the sample stays uniform.
+        size = min(args.sample, args.max_files) if args.max_files > 0 else args.sample
+        # Only the drawn files are stat-ed again, so memory stays O(--sample).
+        with stats_phase("walk"):
+            population, paths = reservoir_sample(
+                iter_files(str(root), args.recursive, keep_stats=False),
+                size,
+                random.Random(args.sample_seed),
+            )
+            paths.sort()
+        sampling = {
+            "method": "reservoir",
+            "population": population,
+            "sample": len(paths),
+            "seed": args.sample_seed,
+            "confidence": SAMPLE_CONFIDENCE,
+        }
+        print(f"[+] Sampled {len(paths)} of {population} files")
+    else:
+        with stats_phase("walk"):
+            paths = sorted(iter_files(str(root), args.recursive))
+    if _RUN_STATS is not None:
+        _RUN_STATS.files["walk"] = population if sampling is not None else len(paths)
+    if args.archives:
+        with stats_phase("archives"):
+            paths = expand_archives(paths, args)
     if args.max_files > 0:
         paths = paths[: args.max_files]
 
@@ -517,9 +4759,94 @@ def main() -> int:
         print("[!] No files found.")
         return 1
 
-    report = build_report(paths, args)
-    print_report(report, args)
+    copies = deduplication = None
+    if args.dedup != "off":
+        with stats_phase("dedup", files=len(paths)):
+            paths, copies, deduplication = find_duplicates(paths, args)
+        print(
+            f"[+] {deduplication['input_files']} files hold "
+            f"{deduplication['unique_files']} distinct contents "
+            f"({deduplication['duplicate_files']} duplicates, counted "
+            f"{'once per copy' if args.dedup == 'weighted' else 'once'})"
+        )
+        if args.dedup == "unique":
+            copies = None
+
+    if args.build_background_index:
+        if np is None:
+            print("[!] Building a background index requires NumPy.")
+            return 2
+        summary = build_background_index(paths, args)
+        print(
+            f"[+] Wrote background index of {summary['file_count']} files "
+            f"({summary['strings']} strings, {summary['ngrams']} n-grams) "
+            f"to: {args.build_background_index}"
+        )
+        return 0
+
+    negatives = None
+    if args.validate_against:
+        negative_root = pathlib.Path(args.validate_against)
+        if not negative_root.is_dir():
+            print(f"[!] Not a directory: {negative_root}")
+            return 2
+        with stats_phase("validation"):
+            negatives = sorted(iter_files(str(negative_root), args.recursive))
+            if args.archives:
+                negatives = expand_archives(negatives, args)
+
+    records = JsonlReport(args.jsonl_out) if args.jsonl_out else None
+    if args.cluster:
+        with contextlib.ExitStack() as scratch:
+            if not args.cache:
+                # Cluster reports reuse the features extracted for clustering
+                # from a scratch cache instead of extracting every file again.
+                scratch_dir = scratch.enter_context(tempfile.TemporaryDirectory())
+                args.cache = os.path.join(scratch_dir, "features.db")
+                scratch.callback(setattr, args, "cache", None)
+            with stats_phase("cluster", files=len(paths)):
+                clusters, unclustered = cluster_samples(paths, args)
+            report = {
+                "file_count": len(paths),
+                "cluster_count": len(clusters),
+                "unclustered": [str(p) for p in unclustered],
+                "clusters": [],
+            }
+            for number, members in enumerate(clusters, 1):
+                print(f"##### Cluster {number} of {len(clusters)}: {len(members)} files")
+                if records is not None:
+                    records.extra = {"cluster": number}
+                cluster_report = build_report(members, args, copies, records)
+                if sampling is not None:
+                    add_sample_presence(cluster_report, sampling)
+                if negatives is not None or args.select_traits:
+                    with stats_phase("validation"):
+                        check_traits(cluster_report, members, negatives, args)
+                with stats_phase("output"):
+                    print_report(cluster_report, args)
+                report["clusters"].append(cluster_report)
+            print(
+                f"[+] {len(clusters)} clusters, {len(unclustered)} unclustered files "
+                f"(of {len(paths)})"
+            )
+    else:
+        report = build_report(paths, args, copies, records)
+        if sampling is not None:
+            add_sample_presence(report, sampling)
+        if negatives is not None or args.select_traits:
+            with stats_phase("validation"):
+                check_traits(report, paths, negatives, args)
+        with stats_phase("output"):
+            print_report(report, args)
 
+    if deduplication is not None:
+        report["deduplication"] = deduplication
+    if _RUN_STATS is not None:
+        report["stats"] = _RUN_STATS.result()
+        print_stats(report["stats"])
+    if records is not None:
+        records.close(report)
+        print(f"[+] Wrote {records.records} file records and the summary to: {records.path}")
     if args.json_out:
         with open(args.json_out, "w", encoding="utf-8") as f:
             json.dump(report, f, indent=2, ensure_ascii=False)